@@ -0,0 +1,103 @@
+"""
+Helpers shared by the extract_*.py scripts: streaming Record elements out of
+export.xml, parsing their dates, staging the export on tmpfs and keying the
+output cache on the export.
+"""
+
+from datetime import date
+import atexit
+import glob
+import hashlib
+import os
+import shutil
+import sys
+
+try:
+    # lxml is optional; its iterparse is several times faster than the stdlib one
+    from lxml import etree as ET
+    HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAVE_LXML = False
+
+def ensure_dir(directory):
+    """Ensure a directory exists, creating it if necessary."""
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def cached_output_path(xml_path, output_path, version):
+    """Build a cache path keyed on the export's mtime and size and the extractor version."""
+    stat = os.stat(xml_path)
+    key = hashlib.blake2b(f"{stat.st_mtime}:{stat.st_size}:{version}".encode(), digest_size=16).hexdigest()
+    output_dir, filename = os.path.split(output_path)
+    name, ext = os.path.splitext(filename)
+    return os.path.join(output_dir, '.cache', f"{name}_{key}{ext}")
+
+def reuse_cached_output(cache_path, output_path):
+    """Copy the cached output into place if there is one, returning whether there was."""
+    if not os.path.exists(cache_path):
+        return False
+    shutil.copyfile(cache_path, output_path)
+    return True
+
+def store_cached_output(output_path, cache_path):
+    """Keep a copy of the output in the cache, removing the copies made for older exports."""
+    cache_dir, filename = os.path.split(cache_path)
+    ensure_dir(cache_dir)
+    
+    # Only the copy for the current export can be reused, so drop the rest
+    # rather than letting the cache grow with every new export
+    name, ext = os.path.splitext(filename)
+    pattern = glob.escape(name.rsplit('_', 1)[0]) + '_' + '[0-9a-f]' * 32 + ext
+    for old_path in glob.glob(os.path.join(glob.escape(cache_dir), pattern)):
+        if old_path != cache_path:
+            os.remove(old_path)
+    
+    shutil.copyfile(output_path, cache_path)
+
+def stage_on_shm(xml_path):
+    """Copy the export to /dev/shm so it is parsed from memory, removing it on exit."""
+    if not sys.platform.startswith('linux'):
+        print("--shm is only supported on Linux, parsing the export in place")
+        return xml_path
+    
+    # The copy takes as much RAM as the export itself
+    shm_path = f"/dev/shm/export_{os.getpid()}.xml"
+    shutil.copyfile(xml_path, shm_path)
+    atexit.register(os.remove, shm_path)
+    print(f"Staged {xml_path} on {shm_path}")
+    return shm_path
+
+def parse_date(date_str):
+    """Parse the calendar date from an Apple Health date string."""
+    # Dates are always 'YYYY-MM-DD HH:MM:SS +HHMM', so slicing out the date
+    # is much cheaper than a full strptime for every record
+    return date(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]))
+
+def iter_records(xml_path, record_type):
+    """Stream Record elements of a given type without loading the whole XML tree."""
+    if HAVE_LXML:
+        # lxml matches the tag in C and lifts the node limits a years-long
+        # export can hit
+        for _, elem in ET.iterparse(xml_path, events=('end',), tag='Record', huge_tree=True):
+            if elem.get('type') == record_type:
+                yield elem
+            
+            # Discard processed elements so memory use stays flat
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return
+    
+    context = ET.iterparse(xml_path, events=('start', 'end'))
+    
+    # The first event is the start of the root HealthData element
+    _, root = next(context)
+    
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'Record':
+            if elem.get('type') == record_type:
+                yield elem
+            
+            # Discard processed elements so memory use stays flat
+            root.clear()
\ No newline at end of file
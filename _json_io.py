@@ -0,0 +1,36 @@
+"""
+Reading and writing the JSON data files, using orjson when it is installed
+and the standard library json module otherwise.
+"""
+
+import json
+import mmap
+
+try:
+    # orjson is optional; it parses and serializes our records several times faster
+    import orjson
+except ImportError:
+    orjson = None
+
+def write_json(records, output_path):
+    """Write a list of records to a JSON file, using orjson when it is installed."""
+    # One compact record per line: still a plain JSON array for the readers,
+    # but a fraction of the size of an indented dump and easy to grep
+    if orjson is not None:
+        with open(output_path, 'wb') as f:
+            f.write(b'[\n' + b',\n'.join(map(orjson.dumps, records)) + b'\n]\n')
+    else:
+        dumps = json.JSONEncoder(separators=(',', ':')).encode
+        with open(output_path, 'w') as f:
+            f.write('[\n' + ',\n'.join(map(dumps, records)) + '\n]\n')
+
+def read_json(json_path):
+    """Read data from a JSON file, using orjson when it is installed."""
+    if orjson is not None:
+        # orjson parses straight from the memory-mapped file, so the file is
+        # never copied into a bytes object first
+        with open(json_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with memoryview(data) as view:
+                return orjson.loads(view)
+    with open(json_path, 'r') as f:
+        return json.load(f)
\ No newline at end of file
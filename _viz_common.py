@@ -0,0 +1,77 @@
+"""
+Helpers shared by the visualize_*.py scripts that chart one value per day:
+loading the JSON data as NumPy arrays, moving averages and grouping by year.
+"""
+
+import numpy as np
+import os
+
+from _json_io import read_json
+
+# Resolution of the saved charts; 150 dpi is sharp on screen and renders a
+# quarter of the pixels of 300 dpi
+DPI = 150
+
+# Fast PNG compression, trading some file size for encoding time
+PNG_OPTIONS = {'compress_level': 1}
+
+# Box drawn behind each chart's statistics text; one shared dict rather than
+# a new one built for every chart
+STATS_BBOX = {'facecolor': 'white', 'alpha': 0.8, 'pad': 5}
+
+def ensure_dir(directory):
+    """Ensure a directory exists, creating it if necessary."""
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def is_up_to_date(output_file, source_mtime):
+    """Check whether a chart was saved after its data last changed."""
+    # A source_mtime of None means the chart is always redrawn
+    return (source_mtime is not None and os.path.exists(output_file)
+            and os.path.getmtime(output_file) >= source_mtime)
+
+def load_timeseries(data_dir, filename, value_key, extractor, dtype=np.float64):
+    """Load one value per day from a JSON file as parallel date and value arrays."""
+    json_path = os.path.join(data_dir, filename)
+    
+    # Check if file exists
+    if not os.path.exists(json_path):
+        raise FileNotFoundError(f"Data file not found at '{json_path}'. Please run {extractor} first.")
+    
+    print(f"Loading data from {json_path}")
+    raw = read_json(json_path)
+    
+    # Keep the dates and values as two parallel arrays rather than a list of
+    # dicts, so the charts work on them directly; NumPy parses the ISO dates
+    dates = np.array([entry['date'] for entry in raw], dtype='datetime64[D]')
+    values = np.fromiter((entry[value_key] for entry in raw), dtype=dtype, count=len(raw))
+    
+    # Sort by date so each year is a contiguous run of the arrays
+    order = np.argsort(dates, kind='stable')
+    
+    return {'dates': dates[order], 'values': values[order]}
+
+def calculate_moving_average(data, window_size):
+    """Calculate moving average for a data series."""
+    # Each window's sum is the difference of two running sums, so the cost is
+    # O(N) rather than re-summing every window; the first window_size - 1
+    # points average over the days seen so far
+    sums = np.cumsum(np.asarray(data, dtype=np.float64))
+    moving_avg = sums / np.minimum(np.arange(1, len(sums) + 1), window_size)
+    moving_avg[window_size:] = (sums[window_size:] - sums[:-window_size]) / window_size
+    
+    return moving_avg
+
+def group_by_year(data):
+    """Group data by year."""
+    dates = data['dates']
+    years_data = {}
+    
+    # The dates are sorted, so each year is one run found by binary search
+    # and its arrays are views of the full arrays rather than copies
+    years = np.unique(dates.astype('datetime64[Y]'))
+    bounds = np.append(np.searchsorted(dates, years.astype('datetime64[D]')), len(dates))
+    for year, start, end in zip(years.astype(int) + 1970, bounds[:-1], bounds[1:]):
+        years_data[int(year)] = {key: column[start:end] for key, column in data.items()}
+    
+    return years_data
\ No newline at end of file
@@ -10,17 +10,12 @@ This resolves an issue where 'asleep' time incorrectly included 'in_bed' time
 after a certain date.
 """
 
-import json
+import bisect
 import os
 from datetime import datetime
-import copy
 
-def ensure_dir(directory):
-    """Ensure a directory exists, creating it if necessary."""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Created directory: {directory}")
-    return directory
+from _json_io import read_json, write_json
+from _extract_common import ensure_dir
 
 def load_sleep_data(data_dir='data', filename='sleep_data.json'):
     """Load sleep data from JSON file."""
@@ -30,8 +25,7 @@ def load_sleep_data(data_dir='data', filename='sleep_data.json'):
         raise FileNotFoundError(f"Data file not found at '{json_path}'. Please run extract_sleep_data.py first.")
     
     print(f"Loading data from {json_path}")
-    with open(json_path, 'r') as f:
-        data = json.load(f)
+    data = read_json(json_path)
     
     print(f"Loaded {len(data)} sleep records")
     return data
@@ -55,8 +49,7 @@ def save_sleep_data(data, data_dir='data', filename='sleep_data_corrected.json',
             print(f"Backup file {backup_path} already exists, skipping backup")
     
     # Save corrected data
-    with open(output_path, 'w') as f:
-        json.dump(data, f, indent=2)
+    write_json(data, output_path)
     
     print(f"Corrected data saved to {output_path}")
     return output_path
@@ -66,31 +59,26 @@ def correct_sleep_data(data, cutoff_date='2024-11-20'):
     Correct sleep data by adjusting 'asleep' value for dates after the cutoff.
     For dates >= cutoff_date: 'asleep' = 'asleep' - 'in_bed'
     """
-    # Parse cutoff date
-    cutoff = datetime.fromisoformat(cutoff_date).date()
+    # Parse cutoff date, normalised back to an ISO string
+    cutoff = datetime.fromisoformat(cutoff_date).date().isoformat()
     
-    # Create a deep copy to avoid modifying the original data
-    corrected_data = copy.deepcopy(data)
+    # The data is sorted by date and ISO date strings sort lexicographically,
+    # so the first record on or after the cutoff can be found by binary search
+    start = bisect.bisect_left([entry['date'] for entry in data], cutoff)
     
     # Counts for reporting
-    total_records = len(corrected_data)
-    corrected_records = 0
+    total_records = len(data)
+    corrected_records = total_records - start
     
-    # Process each record
-    for entry in corrected_data:
-        # Convert date string to datetime.date
-        date = datetime.fromisoformat(entry['date']).date()
-        
-        # Apply correction for dates on or after cutoff
-        if date >= cutoff:
-            # Store original values for reporting
-            original_asleep = entry['asleep']
-            
-            # Apply correction: asleep = asleep - in_bed
-            entry['asleep'] = max(0, original_asleep - entry['in_bed'])
-            
-            # For tracking
-            corrected_records += 1
+    # Records before the cutoff need no correction and are shared with the
+    # original data rather than copied
+    corrected_data = data[:start]
+    
+    # Apply correction to the records on or after the cutoff
+    for entry in data[start:]:
+        # Apply correction on a copy so the original data is left untouched:
+        # asleep = asleep - in_bed
+        corrected_data.append(dict(entry, asleep=max(0, entry['asleep'] - entry['in_bed'])))
     
     print(f"Processed {total_records} records")
     print(f"Applied correction to {corrected_records} records (dates >= {cutoff_date})")
@@ -99,28 +87,29 @@ def correct_sleep_data(data, cutoff_date='2024-11-20'):
 
 def analyze_corrections(original_data, corrected_data):
     """Analyze the changes made to the data."""
-    cutoff_date = datetime.fromisoformat('2024-11-20').date()
+    # ISO date strings sort like the dates they represent, so they can be
+    # compared and used as keys without parsing them
+    cutoff_date = '2024-11-20'
     
     # Convert original data to dict for easier lookup
-    original_dict = {datetime.fromisoformat(entry['date']).date(): entry 
-                    for entry in original_data}
+    original_dict = {entry['date']: entry for entry in original_data}
     
     # Counter for statistics
     affected_records = 0
     total_difference = 0
     
+    # Only records on or after the cutoff can have changed; skip straight to them
+    start = bisect.bisect_left([entry['date'] for entry in corrected_data], cutoff_date)
+    
     # Find the affected records
-    for entry in corrected_data:
-        date = datetime.fromisoformat(entry['date']).date()
+    for entry in corrected_data[start:]:
+        original_asleep = original_dict[entry['date']]['asleep']
+        corrected_asleep = entry['asleep']
         
-        if date >= cutoff_date:
-            original_asleep = original_dict[date]['asleep']
-            corrected_asleep = entry['asleep']
-            
-            if original_asleep != corrected_asleep:
-                affected_records += 1
-                difference = original_asleep - corrected_asleep
-                total_difference += difference
+        if original_asleep != corrected_asleep:
+            affected_records += 1
+            difference = original_asleep - corrected_asleep
+            total_difference += difference
     
     # Print analysis
     if affected_records > 0:
@@ -140,8 +129,7 @@ def update_original_file(corrected_data, data_dir='data'):
     confirm = input("\nDo you want to update the original sleep_data.json file with the corrected data? (y/n): ")
     
     if confirm.lower() == 'y':
-        with open(original_path, 'w') as f:
-            json.dump(corrected_data, f, indent=2)
+        write_json(corrected_data, original_path)
         print(f"Original file {original_path} has been updated with corrected data.")
     else:
         print(f"Original file {original_path} remains unchanged.")
@@ -164,6 +152,6 @@ if __name__ == "__main__":
         update_original_file(corrected_data)
         
         print("\nCorrection process completed successfully.")
-        
+    
     except Exception as e:
         print(f"An error occurred: {e}")
\ No newline at end of file
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Extracts active energy, walking/running distance, resting heart rate, sleep and
+step count data from Apple Health export.xml in a single pass over the file and
+saves each metric's aggregated data as JSON.
+"""
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import mmap
+import os
+import sys
+
+from _extract_common import ET, HAVE_LXML, stage_on_shm
+import extract_active_energy
+import extract_distance
+import extract_resting_hr
+import extract_sleep_data
+import extract_step_count
+
+# Size of the blocks each worker feeds to its parser when --parallel is used
+READ_BLOCK_SIZE = 1 << 20
+
+# How far back to look for an unclosed Correlation when choosing where to split
+CORRELATION_LOOKBACK = 1 << 20
+
+def iter_all_records(xml_path):
+    """Stream every Record element without loading the whole XML tree."""
+    if HAVE_LXML:
+        # lxml matches the tag in C and lifts the node limits a years-long
+        # export can hit
+        for _, elem in ET.iterparse(xml_path, events=('end',), tag='Record', huge_tree=True):
+            yield elem
+            
+            # Discard processed elements so memory use stays flat
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return
+    
+    context = ET.iterparse(xml_path, events=('start', 'end'))
+    
+    # The first event is the start of the root HealthData element
+    _, root = next(context)
+    
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'Record':
+            yield elem
+            
+            # Discard processed elements so memory use stays flat
+            root.clear()
+
+def split_ranges(xml_path, n):
+    """Split the export's records into up to n byte ranges that each hold whole elements."""
+    with open(xml_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # The first range starts at the first element that can hold Records:
+        # a top-level Record, or a Correlation with its Records nested inside
+        starts = [pos for pos in (data.find(b'<Record '), data.find(b'<Correlation ')) if pos != -1]
+        body_end = data.rfind(b'</HealthData>')
+        if not starts or body_end == -1:
+            return []
+        body_start = min(starts)
+        
+        bounds = [body_start]
+        for i in range(1, n):
+            target = body_start + (body_end - body_start) * i // n
+            pos = data.find(b'<Record ', max(target, bounds[-1] + 1), body_end)
+            
+            # Records nested in a Correlation cannot start a range, so move
+            # past the end of the enclosing Correlation
+            while pos != -1:
+                lookback = max(pos - CORRELATION_LOOKBACK, 0)
+                if data.rfind(b'<Correlation ', lookback, pos) <= data.rfind(b'</Correlation>', lookback, pos):
+                    break
+                close = data.find(b'</Correlation>', pos, body_end)
+                pos = -1 if close == -1 else data.find(b'<Record ', close, body_end)
+            
+            if pos == -1:
+                break
+            bounds.append(pos)
+        bounds.append(body_end)
+    
+    return list(zip(bounds, bounds[1:]))
+
+def iter_range_blocks(xml_path, start, end):
+    """Yield one byte range of the export in blocks, wrapped in a synthesised root element."""
+    yield b'<HealthData>'
+    with open(xml_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(READ_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    yield b'</HealthData>'
+
+def iter_range_records(xml_path, start, end):
+    """Stream the Record elements in one byte range of the export."""
+    if HAVE_LXML:
+        parser = ET.XMLPullParser(events=('end',), tag='Record', huge_tree=True)
+    else:
+        parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    
+    for block in iter_range_blocks(xml_path, start, end):
+        parser.feed(block)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                # The first start event is the synthesised root
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag != 'Record':
+                continue
+            
+            yield elem
+            
+            # Discard processed elements so memory use stays flat
+            if HAVE_LXML:
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            else:
+                root.clear()
+    parser.close()
+
+def new_daily_values():
+    """Create an empty per-day aggregator that keeps each day's values."""
+    return defaultdict(lambda: {
+        'values': [],
+        'sources': set()
+    })
+
+def sum_daily_values(days):
+    """Add up each day's values into the per-day totals the extract_*.py scripts build."""
+    totals = {}
+    for key, day in days.items():
+        # Added one at a time from 0 exactly as the scripts do, so the totals
+        # match a single-process run to the last bit; sum() may round
+        # differently as it compensates float sums on newer Pythons
+        total = 0
+        for value in day['values']:
+            total += value
+        totals[key] = {'total': total, 'sources': day['sources']}
+    return totals
+
+def aggregate_records(records):
+    """Aggregate every supported data type from a stream of Record elements."""
+    # Per-day aggregators, updated as each Record streams past. Active energy
+    # and distance keep each day's values rather than a running total, so the
+    # parts can be added up in file order once they are merged
+    active_energy_days = new_daily_values()
+    distance_days = new_daily_values()
+    resting_hr_days = extract_resting_hr.new_daily_totals()
+    sleep_records = []
+    step_records = []
+
+    def collect(parse_record, records):
+        """Build a handler that appends each parsed record to a list."""
+        def add_record(record):
+            parsed = parse_record(record)
+            if parsed is None:
+                return False
+            records.append(parsed)
+            return True
+        return add_record
+
+    def collect_by_day(parse_record, days):
+        """Build a handler that appends each parsed record's value to its day."""
+        def add_record(record):
+            parsed = parse_record(record)
+            if parsed is None:
+                return False
+            day_key, value, source = parsed
+            day = days[day_key]
+            day['values'].append(value)
+            day['sources'].add(source)
+            return True
+        return add_record
+    
+    # Handler for each Health data type handled by this script
+    handlers = {
+        extract_active_energy.RECORD_TYPE:
+            collect_by_day(extract_active_energy.parse_active_energy_record, active_energy_days),
+        extract_distance.RECORD_TYPE:
+            collect_by_day(extract_distance.parse_distance_record, distance_days),
+        extract_resting_hr.RECORD_TYPE:
+            lambda record: extract_resting_hr.add_resting_hr_record(resting_hr_days, record),
+        extract_sleep_data.RECORD_TYPE:
+            collect(extract_sleep_data.parse_sleep_record, sleep_records),
+        extract_step_count.RECORD_TYPE:
+            collect(extract_step_count.parse_step_count_record, step_records),
+    }
+    record_counts = dict.fromkeys(handlers, 0)
+    
+    for elem in records:
+        record_type = elem.get('type')
+        handler = handlers.get(record_type)
+        if handler is not None:
+            try:
+                if handler(elem):
+                    record_counts[record_type] += 1
+            except (ValueError, TypeError) as e:
+                print(f"Error processing {record_type} record: {e}")
+    
+    # Plain dicts, so the partial results can be sent back from a worker process
+    return {
+        'active_energy': dict(active_energy_days),
+        'distance': dict(distance_days),
+        'resting_hr': dict(resting_hr_days),
+        'sleep': sleep_records,
+        'step_count': step_records,
+        'record_counts': record_counts
+    }
+
+def aggregate_range(xml_path, start, end):
+    """Aggregate the records in one byte range of the export (run in a worker process)."""
+    return aggregate_records(iter_range_records(xml_path, start, end))
+
+def merge_daily_totals(days, partial_days):
+    """Add one partial set of per-day values into another."""
+    # Value lists are concatenated, so merging the parts in file order keeps
+    # every day's values in the order a single-process run sees them
+    for key, partial in partial_days.items():
+        day = days[key]
+        for field, value in partial.items():
+            if field == 'sources':
+                day[field] |= value
+            else:
+                day[field] += value
+
+def aggregate_all_from_xml(xml_path, jobs=1):
+    """Aggregate every supported data type, parsing the export in up to jobs processes."""
+    print(f"Parsing {xml_path}...")
+    
+    if jobs > 1:
+        ranges = split_ranges(xml_path, jobs)
+        print(f"Parsing {len(ranges)} parts of the export in parallel")
+        with ProcessPoolExecutor(max_workers=max(len(ranges), 1)) as executor:
+            partials = list(executor.map(aggregate_range, repeat(xml_path),
+                                         [start for start, _ in ranges], [end for _, end in ranges]))
+    else:
+        partials = [aggregate_records(iter_all_records(xml_path))]
+    
+    # Merge the partial results in file order so list-based records keep
+    # their original order
+    active_energy_days = new_daily_values()
+    distance_days = new_daily_values()
+    resting_hr_days = extract_resting_hr.new_daily_totals()
+    sleep_records = []
+    step_records = []
+    record_counts = {}
+    for partial in partials:
+        merge_daily_totals(active_energy_days, partial['active_energy'])
+        merge_daily_totals(distance_days, partial['distance'])
+        merge_daily_totals(resting_hr_days, partial['resting_hr'])
+        sleep_records.extend(partial['sleep'])
+        step_records.extend(partial['step_count'])
+        for record_type, count in partial['record_counts'].items():
+            record_counts[record_type] = record_counts.get(record_type, 0) + count
+    
+    for record_type, count in record_counts.items():
+        print(f"Found {count} {record_type} records")
+    
+    return {
+        'active_energy': extract_active_energy.dict_to_sorted_list(sum_daily_values(active_energy_days)),
+        'distance': extract_distance.dict_to_sorted_list(sum_daily_values(distance_days)),
+        'resting_hr': extract_resting_hr.dict_to_sorted_list(resting_hr_days),
+        'sleep': extract_sleep_data.aggregate_sleep_by_night(sleep_records),
+        'step_count': extract_step_count.aggregate_by_day(step_records)
+    }
+
+if __name__ == "__main__":
+    xml_path = "apple_health_export/export.xml"
+    data_dir = "data"
+    
+    try:
+        print(f"Will save output data to '{data_dir}/' directory")
+        
+        # With --shm, parse a copy of the export staged on tmpfs
+        if '--shm' in sys.argv[1:]:
+            xml_path = stage_on_shm(xml_path)
+        
+        # With --parallel, split the export and parse the parts on every CPU core
+        jobs = (os.cpu_count() or 1) if '--parallel' in sys.argv[1:] else 1
+        
+        # Extract and aggregate all data types in one pass
+        daily_data = aggregate_all_from_xml(xml_path, jobs=jobs)
+        
+        # Save each metric
+        extract_active_energy.save_to_json(daily_data['active_energy'], output_dir=data_dir)
+        extract_distance.save_to_json(daily_data['distance'], output_dir=data_dir)
+        extract_resting_hr.save_to_json(daily_data['resting_hr'], output_dir=data_dir)
+        extract_sleep_data.save_sleep_data_json(daily_data['sleep'], output_dir=data_dir)
+        extract_step_count.save_to_json(daily_data['step_count'], output_dir=data_dir)
+        
+        print("Extraction complete. You can now run the visualize_*.py scripts to generate charts.")
+    
+    except Exception as e:
+        print(f"An error occurred: {e}")
\ No newline at end of file
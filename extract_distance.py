@@ -4,86 +4,78 @@ Extracts walking and running distance data from Apple Health export.xml file
 and saves the aggregated data as JSON.
 """
 
-import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
-import json
+from collections import defaultdict
 import os
+import sys
 
-def ensure_dir(directory):
-    """Ensure a directory exists, creating it if necessary."""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Created directory: {directory}")
-    return directory
+from _json_io import write_json
+from _extract_common import (cached_output_path, ensure_dir, iter_records,
+                             parse_date, reuse_cached_output, stage_on_shm, store_cached_output)
 
-def parse_datetime(date_str):
-    """Parse Apple Health date string into datetime object."""
-    return datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S %z')
+RECORD_TYPE = 'HKQuantityTypeIdentifierDistanceWalkingRunning'
 
-def get_distance_records(xml_path):
-    """Extract walking/running distance records from Apple Health export."""
-    print(f"Parsing {xml_path}...")
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
+# Bump when the extraction logic changes so cached output is not reused
+EXTRACTOR_VERSION = 2
+
+def new_daily_totals():
+    """Create an empty per-day aggregator for distance records."""
+    return defaultdict(lambda: {
+        'total': 0,
+        'sources': set()
+    })
+
+def parse_distance_record(record):
+    """Build a (day, km, source) tuple from a walking/running distance Record element, or None to skip it."""
+    # Get record attributes
+    value = float(record.get('value', 0))
+    unit = record.get('unit', 'km')
+    source = record.get('sourceName', 'Unknown')
+    
+    # Convert to kilometers if in miles
+    if unit == 'mi':
+        value = value * 1.60934
     
+    # Skip records with no or invalid value
+    if value <= 0:
+        return None
+    
+    # Aggregate by the day the record started, keyed on the 'YYYY-MM-DD' prefix
+    # so the date is only parsed once per day rather than once per record
+    return (record.get('startDate')[:10], value, source)
+
+def add_distance_record(days, record):
+    """Add a walking/running distance Record element to the per-day totals."""
+    parsed = parse_distance_record(record)
+    if parsed is None:
+        return False
+    
+    day_key, value, source = parsed
+    day = days[day_key]
+    day['total'] += value
+    day['sources'].add(source)
+    return True
+
+def aggregate_distance_from_xml(xml_path):
+    """Extract walking/running distance records from Apple Health export, aggregated by day."""
+    print(f"Parsing {xml_path}...")
     print("Extracting walking/running distance records...")
-    distance_records = []
+    days = new_daily_totals()
+    record_count = 0
     
-    for record in root.findall(".//Record[@type='HKQuantityTypeIdentifierDistanceWalkingRunning']"):
+    for record in iter_records(xml_path, RECORD_TYPE):
         try:
-            # Get record attributes
-            value = float(record.get('value', 0))
-            unit = record.get('unit', 'km')
-            start_date = parse_datetime(record.get('startDate'))
-            end_date = parse_datetime(record.get('endDate'))
-            source = record.get('sourceName', 'Unknown')
-            
-            # Convert to kilometers if in miles
-            if unit == 'mi':
-                value = value * 1.60934
-                unit = 'km'
-            
-            # Skip records with no or invalid value
-            if value <= 0:
-                continue
-                
-            # Create record object
-            distance_records.append({
-                'start_date': start_date,
-                'end_date': end_date,
-                'value': value,
-                'unit': unit,
-                'source': source,
-                'date': start_date.date()  # For daily aggregation
-            })
-            
+            if add_distance_record(days, record):
+                record_count += 1
         except (ValueError, TypeError) as e:
             print(f"Error processing distance record: {e}")
     
-    print(f"Found {len(distance_records)} walking/running distance records")
-    return distance_records
+    print(f"Found {record_count} walking/running distance records")
+    return days
 
-def aggregate_by_day(records):
-    """Aggregate distance records by day."""
-    from collections import defaultdict
-    
-    # Dictionary to store data by day
-    days = defaultdict(lambda: {
-        'total': 0,
-        'sources': set()
-    })
-    
-    for record in records:
-        date = record['date']
-        value = record['value']
-        source = record['source']
-        
-        days[date]['total'] += value
-        days[date]['sources'].add(source)
-    
-    # Convert to list and sort by date
-    result = [{'date': date, 'distance_km': round(data['total'], 2), 'sources': data['sources']} 
-              for date, data in days.items()]
+def dict_to_sorted_list(days):
+    """Convert per-day distance totals to a list sorted by date."""
+    result = [{'date': parse_date(day), 'distance_km': round(data['total'], 2), 'sources': data['sources']} 
+              for day, data in days.items()]
     result.sort(key=lambda x: x['date'])
     
     return result
@@ -103,9 +95,8 @@ def save_to_json(data, output_dir='data', filename='distance_data.json'):
         serializable_entry['date'] = str(entry['date'])
         serializable_entry['sources'] = list(entry['sources'])
         serializable_data.append(serializable_entry)
-        
-    with open(output_path, 'w') as f:
-        json.dump(serializable_data, f, indent=2)
+    
+    write_json(serializable_data, output_path)
     
     print(f"Data saved as '{output_path}'")
     return output_path
@@ -115,21 +106,32 @@ def calculate_stats(data):
     if not data:
         return {}
     
-    # Calculate total, average, min, max
-    values = [entry['distance_km'] for entry in data]
-    count = len(values)
-    total = sum(values)
-    average = total / count if count > 0 else 0
-    minimum = min(values) if values else 0
-    maximum = max(values) if values else 0
-    
-    # Find date with minimum and maximum values
-    min_date = next((entry['date'] for entry in data if entry['distance_km'] == minimum), None)
-    max_date = next((entry['date'] for entry in data if entry['distance_km'] == maximum), None)
+    # Calculate total, min and max in a single pass, keeping the entries
+    # so the dates of the minimum and maximum come for free
+    total = 0
+    min_entry = max_entry = data[0]
+    days_over_5km = 0
+    days_over_10km = 0
+    for entry in data:
+        value = entry['distance_km']
+        total += value
+        if value < min_entry['distance_km']:
+            min_entry = entry
+        if value > max_entry['distance_km']:
+            max_entry = entry
+        
+        # Count days with significant distance (e.g., > 5 km)
+        if value >= 5:
+            days_over_5km += 1
+        if value >= 10:
+            days_over_10km += 1
     
-    # Calculate days with significant distance (e.g., > 5 km)
-    days_over_5km = sum(1 for v in values if v >= 5)
-    days_over_10km = sum(1 for v in values if v >= 10)
+    count = len(data)
+    average = total / count
+    minimum = min_entry['distance_km']
+    maximum = max_entry['distance_km']
+    min_date = min_entry['date']
+    max_date = max_entry['date']
     
     # Return statistics
     return {
@@ -151,11 +153,23 @@ if __name__ == "__main__":
     try:
         print(f"Will save output data to '{data_dir}/' directory")
         
-        # Extract distance records
-        distance_records = get_distance_records(xml_path)
+        # Reuse the cached output if export.xml has not changed since the last run
+        output_path = os.path.join(data_dir, 'distance_data.json')
+        cache_path = cached_output_path(xml_path, output_path, EXTRACTOR_VERSION)
+        if reuse_cached_output(cache_path, output_path):
+            print(f"{xml_path} is unchanged, reused cached data from {cache_path}")
+            sys.exit(0)
+        
+        # With --shm, parse a copy of the export staged on tmpfs; run_all.py
+        # stages one copy for every script and passes it on with --staged
+        if '--staged' in sys.argv[1:]:
+            xml_path = sys.argv[sys.argv.index('--staged') + 1]
+        elif '--shm' in sys.argv[1:]:
+            xml_path = stage_on_shm(xml_path)
         
-        # Aggregate by day
-        daily_data = aggregate_by_day(distance_records)
+        # Extract distance records, aggregated by day
+        days = aggregate_distance_from_xml(xml_path)
+        daily_data = dict_to_sorted_list(days)
         
         # Calculate stats
         stats = calculate_stats(daily_data)
@@ -173,7 +187,11 @@ if __name__ == "__main__":
         # Save to JSON
         output_path = save_to_json(daily_data, output_dir=data_dir)
         
-        print(f"Extraction complete. Data saved to {output_path}")
+        # Keep a copy keyed on the export so unchanged reruns can skip parsing
+        store_cached_output(output_path, cache_path)
         
+        print(f"Extraction complete. Data saved to {output_path}")
+    
     except Exception as e:
-        print(f"An error occurred: {e}")
\ No newline at end of file
+        print(f"An error occurred: {e}")
+        sys.exit(1)
\ No newline at end of file
@@ -4,87 +4,71 @@ Extracts resting heart rate data from Apple Health export.xml file
 and saves the aggregated data as JSON.
 """
 
-import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
-import json
+from collections import defaultdict
 import os
+import statistics
+import sys
 
-def ensure_dir(directory):
-    """Ensure a directory exists, creating it if necessary."""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Created directory: {directory}")
-    return directory
+from _json_io import write_json
+from _extract_common import (cached_output_path, ensure_dir, iter_records,
+                             parse_date, reuse_cached_output, stage_on_shm, store_cached_output)
 
-def parse_datetime(date_str):
-    """Parse Apple Health date string into datetime object."""
-    return datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S %z')
+RECORD_TYPE = 'HKQuantityTypeIdentifierRestingHeartRate'
 
-def get_resting_hr_records(xml_path):
-    """Extract resting heart rate records from Apple Health export."""
-    print(f"Parsing {xml_path}...")
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
+# Bump when the extraction logic changes so cached output is not reused
+EXTRACTOR_VERSION = 2
+
+def new_daily_totals():
+    """Create an empty per-day aggregator for resting heart rate records."""
+    return defaultdict(lambda: {
+        'values': [],
+        'sources': set()
+    })
+
+def add_resting_hr_record(days, record):
+    """Add a resting heart rate Record element to the per-day readings."""
+    # Get record attributes
+    value = float(record.get('value', 0))
+    source = record.get('sourceName', 'Unknown')
+    
+    # Skip records with no or invalid value
+    if value <= 0 or value > 200:  # Filter unlikely heart rates
+        return False
     
+    # Aggregate by the day the record started, keyed on the 'YYYY-MM-DD' prefix
+    # so the date is only parsed once per day rather than once per record
+    day = days[record.get('startDate')[:10]]
+    day['values'].append(value)
+    day['sources'].add(source)
+    return True
+
+def aggregate_resting_hr_from_xml(xml_path):
+    """Extract resting heart rate records from Apple Health export, aggregated by day."""
+    print(f"Parsing {xml_path}...")
     print("Extracting resting heart rate records...")
-    rhr_records = []
+    days = new_daily_totals()
+    record_count = 0
     
-    for record in root.findall(".//Record[@type='HKQuantityTypeIdentifierRestingHeartRate']"):
+    for record in iter_records(xml_path, RECORD_TYPE):
         try:
-            # Get record attributes
-            value = float(record.get('value', 0))
-            start_date = parse_datetime(record.get('startDate'))
-            end_date = parse_datetime(record.get('endDate'))
-            unit = record.get('unit', 'count/min')
-            source = record.get('sourceName', 'Unknown')
-            
-            # Skip records with no or invalid value
-            if value <= 0 or value > 200:  # Filter unlikely heart rates
-                continue
-                
-            # Create record object
-            rhr_records.append({
-                'start_date': start_date,
-                'end_date': end_date,
-                'value': value,
-                'unit': unit,
-                'source': source,
-                'date': start_date.date()  # For daily aggregation
-            })
-            
+            if add_resting_hr_record(days, record):
+                record_count += 1
         except (ValueError, TypeError) as e:
             print(f"Error processing resting heart rate record: {e}")
     
-    print(f"Found {len(rhr_records)} resting heart rate records")
-    return rhr_records
+    print(f"Found {record_count} resting heart rate records")
+    return days
 
-def aggregate_by_day(records):
-    """Aggregate resting heart rate records by day."""
-    from collections import defaultdict
-    import statistics
-    
-    # Dictionary to store data by day
-    days = defaultdict(lambda: {
-        'values': [],
-        'sources': set()
-    })
-    
-    for record in records:
-        date = record['date']
-        value = record['value']
-        source = record['source']
-        
-        days[date]['values'].append(value)
-        days[date]['sources'].add(source)
-    
+def dict_to_sorted_list(days):
+    """Convert per-day resting heart rate readings to a list sorted by date."""
     # Calculate daily average
     result = []
-    for date, data in days.items():
+    for day, data in days.items():
         values = data['values']
         # If multiple readings in a day, use their mean
         if len(values) > 0:
             result.append({
-                'date': date,
+                'date': parse_date(day),
                 'resting_hr': round(statistics.mean(values), 1),
                 'min_hr': min(values),
                 'max_hr': max(values),
@@ -113,8 +97,7 @@ def save_to_json(data, output_dir='data', filename='resting_hr_data.json'):
         serializable_entry['sources'] = list(entry['sources'])
         serializable_data.append(serializable_entry)
         
-    with open(output_path, 'w') as f:
-        json.dump(serializable_data, f, indent=2)
+    write_json(serializable_data, output_path)
     
     print(f"Data saved as '{output_path}'")
     return output_path
@@ -124,16 +107,24 @@ def calculate_stats(data):
     if not data:
         return {}
     
-    # Calculate average, min, max
-    values = [entry['resting_hr'] for entry in data]
-    count = len(values)
-    average = sum(values) / count if count > 0 else 0
-    minimum = min(values) if values else 0
-    maximum = max(values) if values else 0
+    # Calculate total, min and max in a single pass, keeping the entries
+    # so the dates of the minimum and maximum come for free
+    total = 0
+    min_entry = max_entry = data[0]
+    for entry in data:
+        value = entry['resting_hr']
+        total += value
+        if value < min_entry['resting_hr']:
+            min_entry = entry
+        if value > max_entry['resting_hr']:
+            max_entry = entry
     
-    # Find date with minimum and maximum values
-    min_date = next((entry['date'] for entry in data if entry['resting_hr'] == minimum), None)
-    max_date = next((entry['date'] for entry in data if entry['resting_hr'] == maximum), None)
+    count = len(data)
+    average = total / count
+    minimum = min_entry['resting_hr']
+    maximum = max_entry['resting_hr']
+    min_date = min_entry['date']
+    max_date = max_entry['date']
     
     # Return statistics
     return {
@@ -152,11 +143,23 @@ if __name__ == "__main__":
     try:
         print(f"Will save output data to '{data_dir}/' directory")
         
-        # Extract resting heart rate records
-        rhr_records = get_resting_hr_records(xml_path)
+        # Reuse the cached output if export.xml has not changed since the last run
+        output_path = os.path.join(data_dir, 'resting_hr_data.json')
+        cache_path = cached_output_path(xml_path, output_path, EXTRACTOR_VERSION)
+        if reuse_cached_output(cache_path, output_path):
+            print(f"{xml_path} is unchanged, reused cached data from {cache_path}")
+            sys.exit(0)
         
-        # Aggregate by day
-        daily_data = aggregate_by_day(rhr_records)
+        # With --shm, parse a copy of the export staged on tmpfs; run_all.py
+        # stages one copy for every script and passes it on with --staged
+        if '--staged' in sys.argv[1:]:
+            xml_path = sys.argv[sys.argv.index('--staged') + 1]
+        elif '--shm' in sys.argv[1:]:
+            xml_path = stage_on_shm(xml_path)
+        
+        # Extract resting heart rate records, aggregated by day
+        days = aggregate_resting_hr_from_xml(xml_path)
+        daily_data = dict_to_sorted_list(days)
         
         # Calculate stats
         stats = calculate_stats(daily_data)
@@ -171,7 +174,11 @@ if __name__ == "__main__":
         # Save to JSON
         output_path = save_to_json(daily_data, output_dir=data_dir)
         
+        # Keep a copy keyed on the export so unchanged reruns can skip parsing
+        store_cached_output(output_path, cache_path)
+        
         print(f"Extraction complete. Data saved to {output_path}")
         
     except Exception as e:
-        print(f"An error occurred: {e}")
\ No newline at end of file
+        print(f"An error occurred: {e}")
+        sys.exit(1)
\ No newline at end of file
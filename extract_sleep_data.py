@@ -1,57 +1,94 @@
-import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
-import json
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 import os
+import sys
+
+from _json_io import write_json
+from _extract_common import (cached_output_path, ensure_dir, iter_records,
+                             reuse_cached_output, stage_on_shm, store_cached_output)
+
+RECORD_TYPE = 'HKCategoryTypeIdentifierSleepAnalysis'
+
+# Bump when the extraction logic changes so cached output is not reused
+EXTRACTOR_VERSION = 2
+
+@lru_cache(maxsize=None)
+def parse_utc_offset(offset):
+    """Convert a '+HHMM' or '-HHMM' UTC offset into a timezone object."""
+    sign = -1 if offset[0] == '-' else 1
+    return timezone(sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5])))
 
 def parse_datetime(date_str):
     """Parse Apple Health date string into datetime object."""
-    return datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S %z')
+    # Dates are always 'YYYY-MM-DD HH:MM:SS +HHMM', so slice the fields
+    # directly instead of running strptime for every record
+    return datetime(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]),
+                    int(date_str[11:13]), int(date_str[14:16]), int(date_str[17:19]),
+                    tzinfo=parse_utc_offset(date_str[20:]))
+
+@lru_cache(maxsize=None)
+def sleep_category(value):
+    """Map a sleep analysis value to the night bucket it is counted in."""
+    # There are only a handful of distinct values, so the substring checks
+    # run once per value rather than once per record
+    if 'Asleep' in value:
+        return 'asleep'
+    elif 'InBed' in value:
+        return 'in_bed'
+    return 'unspecified'
+
+def parse_sleep_record(record):
+    """Build a record dict from a sleep analysis Record element, or None to skip it."""
+    # Get record attributes
+    value = record.get('value')
+    start_date = parse_datetime(record.get('startDate'))
+    
+    # If sleep starts between 8am and 6pm, it's likely a nap rather than night
+    # sleep; naps are left out of the night analysis, so skip them here
+    if 8 < start_date.hour < 18:
+        return None
+    
+    end_date = parse_datetime(record.get('endDate'))
+    # Records are kept until they are aggregated, so share one string object
+    # per source name rather than holding a copy in every record
+    source = sys.intern(record.get('sourceName', 'Unknown'))
+    
+    # Calculate duration in hours
+    duration = (end_date - start_date).total_seconds() / 3600
+    
+    # Skip extremely short or long durations (likely errors)
+    if duration < 0.1 or duration > 24:
+        return None
+    
+    # Get date for the "night" (the previous day if sleep started after midnight)
+    night_date = start_date.date()
+    if start_date.hour < 6:
+        night_date = (start_date - timedelta(days=1)).date()
+    
+    return {
+        'start_date': start_date,
+        'end_date': end_date,
+        'duration': duration,
+        'value': value,
+        'source': source,
+        'night_date': night_date
+    }
 
 def get_sleep_records(xml_path):
     """Extract sleep analysis records from Apple Health export."""
     print(f"Parsing {xml_path}...")
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-    
     print("Extracting sleep records...")
     sleep_records = []
     
-    for record in root.findall(".//Record[@type='HKCategoryTypeIdentifierSleepAnalysis']"):
+    for record in iter_records(xml_path, RECORD_TYPE):
         try:
-            # Get record attributes
-            value = record.get('value')
-            start_date = parse_datetime(record.get('startDate'))
-            end_date = parse_datetime(record.get('endDate'))
-            source = record.get('sourceName', 'Unknown')
-            
-            # Calculate duration in hours
-            duration = (end_date - start_date).total_seconds() / 3600
-            
-            # Skip extremely short or long durations (likely errors)
-            if duration < 0.1 or duration > 24:
-                continue
-                
-            # Create a date string for the night (using the start date)
-            # If sleep starts before 6pm, it's likely a nap rather than night sleep
-            is_nap = start_date.hour < 18 and start_date.hour > 8
-            
-            # Get date for the "night" (the previous day if sleep started after midnight)
-            night_date = start_date.date()
-            if start_date.hour < 6:
-                night_date = (start_date - timedelta(days=1)).date()
-            
-            sleep_records.append({
-                'start_date': start_date,
-                'end_date': end_date,
-                'duration': duration,
-                'value': value,
-                'source': source,
-                'night_date': night_date,
-                'is_nap': is_nap
-            })
-            
+            parsed = parse_sleep_record(record)
         except (ValueError, TypeError) as e:
             print(f"Error processing sleep record: {e}")
+            continue
+        
+        if parsed is not None:
+            sleep_records.append(parsed)
     
     print(f"Found {len(sleep_records)} sleep records")
     return sleep_records
@@ -75,19 +112,10 @@ def aggregate_sleep_by_night(sleep_records):
         value = record['value']
         source = record['source']
         
-        # Skip naps for night sleep analysis
-        if record['is_nap']:
-            continue
-            
         nights[night]['sources'].add(source)
         
         # Categorize by sleep type
-        if 'Asleep' in value:
-            nights[night]['asleep'] += duration
-        elif 'InBed' in value:
-            nights[night]['in_bed'] += duration
-        else:
-            nights[night]['unspecified'] += duration
+        nights[night][sleep_category(value)] += duration
             
         # Add to total regardless of type
         nights[night]['total'] += duration
@@ -98,13 +126,6 @@ def aggregate_sleep_by_night(sleep_records):
     
     return result
 
-def ensure_dir(directory):
-    """Ensure a directory exists, creating it if necessary."""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Created directory: {directory}")
-    return directory
-
 def save_sleep_data_json(sleep_data, output_dir='data', filename='sleep_data.json'):
     """Save processed sleep data to JSON file in the specified directory."""
     # Ensure the output directory exists
@@ -121,8 +142,7 @@ def save_sleep_data_json(sleep_data, output_dir='data', filename='sleep_data.jso
         serializable_entry['sources'] = list(entry['sources'])
         serializable_data.append(serializable_entry)
         
-    with open(output_path, 'w') as f:
-        json.dump(serializable_data, f, indent=2)
+    write_json(serializable_data, output_path)
     
     print(f"Data saved as '{output_path}'")
     return output_path
@@ -134,6 +154,20 @@ if __name__ == "__main__":
     try:
         print(f"Will save output data to '{data_dir}/' directory")
         
+        # Reuse the cached output if export.xml has not changed since the last run
+        output_path = os.path.join(data_dir, 'sleep_data.json')
+        cache_path = cached_output_path(xml_path, output_path, EXTRACTOR_VERSION)
+        if reuse_cached_output(cache_path, output_path):
+            print(f"{xml_path} is unchanged, reused cached data from {cache_path}")
+            sys.exit(0)
+        
+        # With --shm, parse a copy of the export staged on tmpfs; run_all.py
+        # stages one copy for every script and passes it on with --staged
+        if '--staged' in sys.argv[1:]:
+            xml_path = sys.argv[sys.argv.index('--staged') + 1]
+        elif '--shm' in sys.argv[1:]:
+            xml_path = stage_on_shm(xml_path)
+        
         # Extract sleep records
         sleep_records = get_sleep_records(xml_path)
         
@@ -143,7 +177,11 @@ if __name__ == "__main__":
         # Save to JSON in the data directory
         output_path = save_sleep_data_json(sleep_data, output_dir=data_dir)
         
+        # Keep a copy keyed on the export so unchanged reruns can skip parsing
+        store_cached_output(output_path, cache_path)
+        
         print(f"Extraction complete. You can now run visualize_sleep_charts.py to generate charts.")
         
     except Exception as e:
-        print(f"An error occurred: {e}")
\ No newline at end of file
+        print(f"An error occurred: {e}")
+        sys.exit(1)
\ No newline at end of file
@@ -4,56 +4,49 @@ Extracts daily step count data from Apple Health export.xml file
 and saves the aggregated data as JSON.
 """
 
-import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
-import json
 import os
+import sys
 
-def ensure_dir(directory):
-    """Ensure a directory exists, creating it if necessary."""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Created directory: {directory}")
-    return directory
+from _json_io import write_json
+from _extract_common import (cached_output_path, ensure_dir, iter_records,
+                             parse_date, reuse_cached_output, stage_on_shm, store_cached_output)
 
-def parse_datetime(date_str):
-    """Parse Apple Health date string into datetime object."""
-    return datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S %z')
+RECORD_TYPE = 'HKQuantityTypeIdentifierStepCount'
+
+# Bump when the extraction logic changes so cached output is not reused
+EXTRACTOR_VERSION = 2
+
+def parse_step_count_record(record):
+    """Build a (day, steps, source) tuple from a step count Record element, or None to skip it."""
+    # Get record attributes
+    value = int(float(record.get('value', 0)))
+    # Records are kept until they are aggregated, so share one string object
+    # per source name rather than holding a copy in every record
+    source = sys.intern(record.get('sourceName', 'Unknown'))
+    
+    # Skip records with no or invalid value
+    if value <= 0:
+        return None
+    
+    # A small tuple rather than a dict per record, keyed on the 'YYYY-MM-DD'
+    # prefix so the date is only parsed once per day when aggregating
+    return (record.get('startDate')[:10], value, source)
 
 def get_step_count_records(xml_path):
     """Extract step count records from Apple Health export."""
     print(f"Parsing {xml_path}...")
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-    
     print("Extracting step count records...")
     step_records = []
     
-    for record in root.findall(".//Record[@type='HKQuantityTypeIdentifierStepCount']"):
+    for record in iter_records(xml_path, RECORD_TYPE):
         try:
-            # Get record attributes
-            value = int(float(record.get('value', 0)))
-            start_date = parse_datetime(record.get('startDate'))
-            end_date = parse_datetime(record.get('endDate'))
-            unit = record.get('unit', 'count')
-            source = record.get('sourceName', 'Unknown')
-            
-            # Skip records with no or invalid value
-            if value <= 0:
-                continue
-                
-            # Create record object
-            step_records.append({
-                'start_date': start_date,
-                'end_date': end_date,
-                'value': value,
-                'unit': unit,
-                'source': source,
-                'date': start_date.date()  # For daily aggregation
-            })
-            
+            parsed = parse_step_count_record(record)
         except (ValueError, TypeError) as e:
             print(f"Error processing step count record: {e}")
+            continue
+        
+        if parsed is not None:
+            step_records.append(parsed)
     
     print(f"Found {len(step_records)} step count records")
     return step_records
@@ -62,24 +55,18 @@ def aggregate_by_day(records):
     """Aggregate step count records by day."""
     from collections import defaultdict
     
-    # Dictionary to store data by day
-    days = defaultdict(lambda: {
-        'total': 0,
-        'sources': set()
-    })
+    # Totals and sources by day, kept in separate dicts with builtin
+    # factories rather than a dict per day built by a lambda
+    totals = defaultdict(int)
+    sources = defaultdict(set)
     
-    for record in records:
-        date = record['date']
-        value = record['value']
-        source = record['source']
-        
-        days[date]['total'] += value
-        days[date]['sources'].add(source)
+    for day, value, source in records:
+        totals[day] += value
+        sources[day].add(source)
     
-    # Convert to list and sort by date
-    result = [{'date': date, 'steps': data['total'], 'sources': data['sources']} 
-              for date, data in days.items()]
-    result.sort(key=lambda x: x['date'])
+    # Convert to list sorted by date; 'YYYY-MM-DD' keys sort chronologically
+    result = [{'date': parse_date(day), 'steps': totals[day], 'sources': sources[day]} 
+              for day in sorted(totals)]
     
     return result
 
@@ -92,15 +79,10 @@ def save_to_json(data, output_dir='data', filename='step_count_data.json'):
     output_path = os.path.join(output_dir, filename)
     
     # Convert date objects and sets to strings for JSON serialization
-    serializable_data = []
-    for entry in data:
-        serializable_entry = entry.copy()
-        serializable_entry['date'] = str(entry['date'])
-        serializable_entry['sources'] = list(entry['sources'])
-        serializable_data.append(serializable_entry)
-        
-    with open(output_path, 'w') as f:
-        json.dump(serializable_data, f, indent=2)
+    serializable_data = [{'date': entry['date'].isoformat(), 'steps': entry['steps'], 'sources': list(entry['sources'])} 
+                         for entry in data]
+    
+    write_json(serializable_data, output_path)
     
     print(f"Data saved as '{output_path}'")
     return output_path
@@ -110,17 +92,24 @@ def calculate_stats(data):
     if not data:
         return {}
     
-    # Calculate total, average, min, max
-    values = [entry['steps'] for entry in data]
-    count = len(values)
-    total = sum(values)
-    average = total / count if count > 0 else 0
-    minimum = min(values) if values else 0
-    maximum = max(values) if values else 0
+    # Calculate total, min and max in a single pass, keeping the entries
+    # so the dates of the minimum and maximum come for free
+    total = 0
+    min_entry = max_entry = data[0]
+    for entry in data:
+        value = entry['steps']
+        total += value
+        if value < min_entry['steps']:
+            min_entry = entry
+        if value > max_entry['steps']:
+            max_entry = entry
     
-    # Find date with minimum and maximum values
-    min_date = next((entry['date'] for entry in data if entry['steps'] == minimum), None)
-    max_date = next((entry['date'] for entry in data if entry['steps'] == maximum), None)
+    count = len(data)
+    average = total / count
+    minimum = min_entry['steps']
+    maximum = max_entry['steps']
+    min_date = min_entry['date']
+    max_date = max_entry['date']
     
     # Return statistics
     return {
@@ -140,6 +129,20 @@ if __name__ == "__main__":
     try:
         print(f"Will save output data to '{data_dir}/' directory")
         
+        # Reuse the cached output if export.xml has not changed since the last run
+        output_path = os.path.join(data_dir, 'step_count_data.json')
+        cache_path = cached_output_path(xml_path, output_path, EXTRACTOR_VERSION)
+        if reuse_cached_output(cache_path, output_path):
+            print(f"{xml_path} is unchanged, reused cached data from {cache_path}")
+            sys.exit(0)
+        
+        # With --shm, parse a copy of the export staged on tmpfs; run_all.py
+        # stages one copy for every script and passes it on with --staged
+        if '--staged' in sys.argv[1:]:
+            xml_path = sys.argv[sys.argv.index('--staged') + 1]
+        elif '--shm' in sys.argv[1:]:
+            xml_path = stage_on_shm(xml_path)
+        
         # Extract step count records
         step_records = get_step_count_records(xml_path)
         
@@ -160,7 +163,11 @@ if __name__ == "__main__":
         # Save to JSON
         output_path = save_to_json(daily_data, output_dir=data_dir)
         
+        # Keep a copy keyed on the export so unchanged reruns can skip parsing
+        store_cached_output(output_path, cache_path)
+        
         print(f"Extraction complete. Data saved to {output_path}")
         
     except Exception as e:
-        print(f"An error occurred: {e}")
\ No newline at end of file
+        print(f"An error occurred: {e}")
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Runs every extract_*.py script concurrently, one process per script, so the
+parsing of Apple Health export.xml is spread over several CPU cores.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import os
+import runpy
+import sys
+
+from _extract_common import stage_on_shm
+
+EXTRACTORS = [
+    'extract_active_energy',
+    'extract_distance',
+    'extract_resting_hr',
+    'extract_sleep_data',
+    'extract_step_count'
+]
+
+def run_extractor(module_name, staged_path=None):
+    """Run an extraction script as if it had been started from the command line, returning its exit status."""
+    # Hand the script the export copy already staged on tmpfs rather than
+    # letting every script stage its own
+    sys.argv = [f"{module_name}.py"] + (['--staged', staged_path] if staged_path else [])
+    try:
+        runpy.run_module(module_name, run_name='__main__')
+    except SystemExit as e:
+        # Scripts exit with status 0 when they reuse their cached output, and
+        # non-zero when they fail
+        if e.code is None:
+            return 0
+        return e.code if isinstance(e.code, int) else 1
+    return 0
+
+if __name__ == "__main__":
+    xml_path = "apple_health_export/export.xml"
+    
+    # With --shm, stage one copy of the export on tmpfs for all the scripts
+    staged_path = stage_on_shm(xml_path) if '--shm' in sys.argv[1:] else None
+    
+    max_workers = min(len(EXTRACTORS), os.cpu_count() or 1)
+    print(f"Running {len(EXTRACTORS)} extraction scripts with {max_workers} worker processes")
+    
+    failed = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for name, status in zip(EXTRACTORS, executor.map(run_extractor, EXTRACTORS, repeat(staged_path))):
+            if status != 0:
+                print(f"{name}.py failed with exit status {status}")
+                failed.append(name)
+            else:
+                print(f"Finished {name}.py")
+    
+    if failed:
+        sys.exit(1)
+    
+    print("Extraction complete. You can now run the visualize_*.py scripts to generate charts.")
\ No newline at end of file
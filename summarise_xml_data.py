@@ -1,12 +1,16 @@
-import xml.etree.ElementTree as ET
 from collections import defaultdict
 import json
 import os
 
+from _extract_common import ET, HAVE_LXML, ensure_dir
+
 def analyze_xml_structure(xml_path):
     print(f"Parsing {xml_path}...")
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
+    if HAVE_LXML:
+        # Lift lxml's node limits, which a years-long export can hit
+        context = ET.iterparse(xml_path, events=('start', 'end'), huge_tree=True)
+    else:
+        context = ET.iterparse(xml_path, events=('start', 'end'))
     
     print("Analyzing XML structure...")
     # Dictionary to store information about each type of Record
@@ -25,37 +29,56 @@ def analyze_xml_structure(xml_path):
         'example': None
     })
     
-    # Process all elements in the XML
-    for element in root.findall('.//*'):
+    # Elements that have started but not yet ended; the first is the root
+    open_elements = []
+    
+    # Process every element below the root as the XML is streamed
+    for event, element in context:
         tag = element.tag
         
+        if event == 'start':
+            # Register element types in document order so the summary lists
+            # them in the order they first appear
+            if open_elements and tag != 'Record':
+                element_types[tag]
+            open_elements.append(element)
+            continue
+        
+        open_elements.pop()
+        if not open_elements:
+            # The root element itself is not summarised
+            continue
+        parent = open_elements[-1]
+        
         # Handle Record elements specially
         if tag == 'Record':
             record_type = element.get('type')
             if record_type:
+                # Look up this type's summary once per record
+                info = data_types[record_type]
+                date_range = info['date_range']
+                
                 # Increment count
-                data_types[record_type]['count'] += 1
+                info['count'] += 1
                 
                 # Collect all attributes
-                for attr_name, attr_value in element.attrib.items():
-                    data_types[record_type]['attributes'].add(attr_name)
+                info['attributes'].update(element.attrib.keys())
                 
                 # Store first example
-                if data_types[record_type]['example'] is None:
-                    data_types[record_type]['example'] = dict(element.attrib)
+                if info['example'] is None:
+                    info['example'] = dict(element.attrib)
                 
-                # Update date range if available
+                # Update date range if available; the dates are fixed-format
+                # strings, so they order correctly as plain strings
                 start_date = element.get('startDate')
                 if start_date:
-                    if (data_types[record_type]['date_range']['start'] is None or 
-                        start_date < data_types[record_type]['date_range']['start']):
-                        data_types[record_type]['date_range']['start'] = start_date
+                    if date_range['start'] is None or start_date < date_range['start']:
+                        date_range['start'] = start_date
                 
                 end_date = element.get('endDate')
                 if end_date:
-                    if (data_types[record_type]['date_range']['end'] is None or 
-                        end_date > data_types[record_type]['date_range']['end']):
-                        data_types[record_type]['date_range']['end'] = end_date
+                    if date_range['end'] is None or end_date > date_range['end']:
+                        date_range['end'] = end_date
         else:
             # For non-Record elements
             element_types[tag]['count'] += 1
@@ -64,13 +87,17 @@ def analyze_xml_structure(xml_path):
             for attr_name, attr_value in element.attrib.items():
                 element_types[tag]['attributes'].add(attr_name)
             
-            # Collect child element tags
-            for child in element:
-                element_types[tag]['children'].add(child.tag)
-            
             # Store first example
             if element_types[tag]['example'] is None and element.attrib:
                 element_types[tag]['example'] = dict(element.attrib)
+        
+        # Collect child element tags on the parent, since the element is
+        # discarded before the parent ends
+        if len(open_elements) > 1 and parent.tag != 'Record':
+            element_types[parent.tag]['children'].add(tag)
+        
+        # Discard the processed element so memory use stays flat
+        parent.remove(element)
     
     return {
         'data_types': {k: {
@@ -87,13 +114,6 @@ def analyze_xml_structure(xml_path):
         } for k, v in element_types.items()}
     }
 
-def ensure_dir(directory):
-    """Ensure a directory exists, creating it if necessary."""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Created directory: {directory}")
-    return directory
-
 def format_output(structure):
     output = []
     
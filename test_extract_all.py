@@ -0,0 +1,55 @@
+"""
+Checks that extract_all.py's --parallel mode reads the same records, and
+adds them up to the same totals, as a single-process run.
+"""
+
+import extract_all
+
+STEP_RECORD = (' <Record type="HKQuantityTypeIdentifierStepCount" sourceName="iPhone" unit="count" '
+               'startDate="2022-11-{day:02d} 08:00:00 +0000" endDate="2022-11-{day:02d} 08:05:00 +0000" '
+               'value="{value}"/>\n')
+
+QUANTITY_RECORD = (' <Record type="{type}" sourceName="Watch" unit="{unit}" '
+                   'startDate="2022-11-{day:02d} 09:00:00 +0000" endDate="2022-11-{day:02d} 09:05:00 +0000" '
+                   'value="{value}"/>\n')
+
+def write_export(path):
+    """Write a small export whose first Record is nested in a Correlation."""
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n',
+        '<HealthData locale="en_GB">\n',
+        ' <ExportDate value="2022-12-01 10:00:00 +0000"/>\n',
+        ' <Correlation type="HKCorrelationTypeIdentifierBloodPressure" sourceName="iPhone" '
+        'startDate="2022-11-01 08:00:00 +0000" endDate="2022-11-01 08:00:00 +0000">\n',
+        ' ' + STEP_RECORD.format(day=1, value=500),
+        ' </Correlation>\n',
+    ]
+    for i in range(200):
+        parts.append(STEP_RECORD.format(day=i % 28 + 1, value=100 + i))
+        # Values whose float total depends on the order they are added in
+        parts.append(QUANTITY_RECORD.format(type='HKQuantityTypeIdentifierActiveEnergyBurned', unit='kcal',
+                                            day=i % 3 + 1, value=0.1 + i * 1e-3 + (1e6 if i % 7 == 0 else 0)))
+        parts.append(QUANTITY_RECORD.format(type='HKQuantityTypeIdentifierDistanceWalkingRunning', unit='mi',
+                                            day=i % 3 + 1, value=0.01 * (i + 1)))
+    parts.append('</HealthData>\n')
+    path.write_text(''.join(parts))
+    return str(path)
+
+def test_split_ranges_starts_before_leading_correlation(tmp_path):
+    xml_path = write_export(tmp_path / 'export.xml')
+    with open(xml_path, 'rb') as f:
+        data = f.read()
+    
+    ranges = extract_all.split_ranges(xml_path, 4)
+    assert ranges[0][0] == data.find(b'<Correlation ')
+    assert len(ranges) > 1
+
+def test_parallel_matches_single_process(tmp_path):
+    xml_path = write_export(tmp_path / 'export.xml')
+    
+    serial = extract_all.aggregate_all_from_xml(xml_path)
+    parallel = extract_all.aggregate_all_from_xml(xml_path, jobs=4)
+    assert parallel['step_count'] == serial['step_count']
+    assert parallel['active_energy'] == serial['active_energy']
+    assert parallel['distance'] == serial['distance']
+    assert serial['step_count'][0]['steps'] == 500 + sum(100 + i for i in range(0, 200, 28))
\ No newline at end of file
@@ -4,68 +4,31 @@ Visualizes daily active energy burned data from Apple Health.
 Creates charts showing daily active calories and trends over time.
 """
 
+import matplotlib
+# Render straight to PNG files without initialising a GUI backend
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import numpy as np
-from datetime import datetime
-import json
 import os
 
-def ensure_dir(directory):
-    """Ensure a directory exists, creating it if necessary."""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Created directory: {directory}")
-    return directory
+from _viz_common import (DPI, PNG_OPTIONS, STATS_BBOX, ensure_dir, load_timeseries,
+                         calculate_moving_average, group_by_year)
 
 def load_active_energy_data(data_dir='data', filename='active_energy_data.json'):
     """Load active energy data from JSON file in the specified directory."""
-    json_path = os.path.join(data_dir, filename)
-    
-    # Check if file exists
-    if not os.path.exists(json_path):
-        raise FileNotFoundError(f"Data file not found at '{json_path}'. Please run extract_active_energy.py first.")
-    
-    print(f"Loading data from {json_path}")
-    with open(json_path, 'r') as f:
-        data = json.load(f)
-    
-    # Convert date strings back to datetime.date objects
-    for entry in data:
-        entry['date'] = datetime.fromisoformat(entry['date']).date()
-    
-    return data
-
-def calculate_moving_average(data, window_size):
-    """Calculate moving average for a data series."""
-    moving_avg = []
-    
-    for i in range(len(data)):
-        if i < window_size - 1:
-            window = data[:i+1]
-        else:
-            window = data[i-window_size+1:i+1]
-        moving_avg.append(sum(window) / len(window))
-    
-    return moving_avg
+    return load_timeseries(data_dir, filename, 'active_calories', 'extract_active_energy.py')
 
-def group_by_year(data):
-    """Group data by year."""
-    years_data = {}
+def plot_active_energy_chart(data, year=None, output_dir='outputs', fig=None):
+    """Create visualization for active energy burned, optionally on a reused figure."""
+    dates = data['dates']
+    active_calories = data['values']
     
-    for entry in data:
-        year = entry['date'].year
-        if year not in years_data:
-            years_data[year] = []
-        years_data[year].append(entry)
-    
-    return years_data
-
-def plot_active_energy_chart(data, year=None, output_dir='outputs'):
-    """Create visualization for active energy burned."""
-    # Extract dates and values
-    dates = [entry['date'] for entry in data]
-    active_calories = [entry['active_calories'] for entry in data]
+    # Statistics for the y-axis limit and the summary box, each one C-level
+    # reduction over the array
+    avg_calories = active_calories.mean()
+    min_calories = active_calories.min()
+    max_calories = active_calories.max()
     
     # Set default output file based on year
     year_str = f"_{year}" if year else ""
@@ -74,96 +37,78 @@ def plot_active_energy_chart(data, year=None, output_dir='outputs'):
     # Ensure output directory exists
     ensure_dir(output_dir)
     
-    # Convert dates to matplotlib dates
-    dates_mdates = mdates.date2num(dates)
-    
     # Calculate moving average (7-day window)
     window_size = 7
     moving_avg = calculate_moving_average(active_calories, window_size)
     
-    # Create the plot
-    plt.figure(figsize=(15, 8))
+    # Draw on the shared figure when one is given, otherwise on a new one
+    owns_figure = fig is None
+    if owns_figure:
+        fig = plt.figure(figsize=(15, 8))
+    else:
+        fig.clf()
+    ax = fig.add_subplot()
     
     # Define colors
     bar_color = '#e55934'  # orange-red
     line_color = '#3a7ebf'  # blue
     
     # Create bar chart
-    plt.bar(dates_mdates, active_calories, label='Active Calories', color=bar_color, alpha=0.7)
+    ax.bar(dates, active_calories, label='Active Calories', color=bar_color, alpha=0.7)
     
     # Plot 7-day moving average
-    plt.plot(dates_mdates, moving_avg, color=line_color, linewidth=2.5, 
-             label=f'{window_size}-Day Moving Average')
+    ax.plot(dates, moving_avg, color=line_color, linewidth=2.5, 
+            label=f'{window_size}-Day Moving Average')
     
     # Configure x-axis
     if year:
         # For single year charts, show months
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%b'))
-        plt.gca().xaxis.set_major_locator(mdates.MonthLocator())
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%b'))
+        ax.xaxis.set_major_locator(mdates.MonthLocator())
     else:
         # For all data, show year-month
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
-        plt.gca().xaxis.set_major_locator(mdates.MonthLocator(interval=2))
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
+        ax.xaxis.set_major_locator(mdates.MonthLocator(interval=2))
     
-    plt.gcf().autofmt_xdate()
+    fig.autofmt_xdate()
     
     # Configure y-axis
-    max_calories = max(active_calories) * 1.1  # Add 10% headroom
-    plt.ylim(0, max_calories)
-    plt.ylabel('Active Calories (kcal)')
+    ax.set_ylim(0, max_calories * 1.1)  # Add 10% headroom
+    ax.set_ylabel('Active Calories (kcal)')
     
     # Add grid, legend and title
-    plt.grid(True, alpha=0.3)
-    plt.legend(loc='upper left')
+    ax.grid(True, alpha=0.3)
+    ax.legend(loc='upper left')
     
     # Set title based on year
     title = f"Active Energy Burned in {year}" if year else "Active Energy Burned Over All Years"
-    plt.title(title)
-    
-    # Calculate statistics
-    avg_calories = sum(active_calories) / len(active_calories)
-    min_calories = min(active_calories)
-    max_calories = max(active_calories)
+    ax.set_title(title)
     
     # Add text box with statistics
     stats_text = (
-        f"Days recorded: {len(dates)}\n"
+        f"Days recorded: {active_calories.size}\n"
         f"Average: {avg_calories:.2f} kcal\n"
         f"Min: {min_calories:.2f} kcal\n"
         f"Max: {max_calories:.2f} kcal"
     )
-    plt.figtext(0.15, 0.02, stats_text, fontsize=10, 
-                bbox={'facecolor': 'white', 'alpha': 0.8, 'pad': 5})
+    fig.text(0.15, 0.02, stats_text, fontsize=10, bbox=STATS_BBOX)
     
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=DPI, pil_kwargs=PNG_OPTIONS)
     print(f"Active energy chart saved as '{output_file}'")
-    plt.close()
+    if owns_figure:
+        plt.close(fig)
 
 def plot_monthly_averages(data, output_dir='outputs'):
     """Create a chart showing average active energy by month across all years."""
-    from collections import defaultdict
-    
-    # Group by year and month
-    monthly_data = defaultdict(list)
+    # The dates are sorted, so each month is one run of the arrays starting
+    # at its first index; sum each run in one reduction
+    months, starts = np.unique(data['dates'].astype('datetime64[M]'), return_index=True)
+    counts = np.diff(np.append(starts, len(data['dates'])))
+    avg_values = np.add.reduceat(data['values'], starts) / counts
     
-    for entry in data:
-        date = entry['date']
-        # Create a key in the format (year, month)
-        key = (date.year, date.month)
-        monthly_data[key].append(entry['active_calories'])
-    
-    # Calculate monthly averages
-    monthly_avgs = {}
-    for (year, month), values in monthly_data.items():
-        monthly_avgs[(year, month)] = sum(values) / len(values)
-    
-    # Sort by date
-    sorted_months = sorted(monthly_avgs.keys())
-    
-    # Create x-axis labels and y-axis values
-    month_labels = [f"{year}-{month:02d}" for year, month in sorted_months]
-    avg_values = [monthly_avgs[key] for key in sorted_months]
+    # Create x-axis labels ('YYYY-MM')
+    month_labels = months.astype(str)
     
     # Set output file
     output_file = os.path.join(output_dir, "monthly_active_energy_averages.png")
@@ -188,7 +133,7 @@ def plot_monthly_averages(data, output_dir='outputs'):
     plt.title('Average Daily Active Energy by Month')
     
     plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
+    plt.savefig(output_file, dpi=DPI, pil_kwargs=PNG_OPTIONS)
     print(f"Monthly averages chart saved as '{output_file}'")
     plt.close()
 
@@ -206,9 +151,12 @@ if __name__ == "__main__":
         ensure_dir(OUTPUT_DIR)
         print(f"All charts will be saved to the '{OUTPUT_DIR}' directory")
         
+        # One figure is cleared and redrawn for the combined and yearly charts
+        chart_figure = plt.figure(figsize=(15, 8))
+        
         # Create chart for all data
         print("\nGenerating chart for all years combined...")
-        plot_active_energy_chart(active_energy_data, output_dir=OUTPUT_DIR)
+        plot_active_energy_chart(active_energy_data, output_dir=OUTPUT_DIR, fig=chart_figure)
         
         # Create monthly averages chart
         print("\nGenerating monthly averages chart...")
@@ -217,7 +165,7 @@ if __name__ == "__main__":
         # Group data by year
         print("\nGrouping data by year...")
         years_data = group_by_year(active_energy_data)
-        years = sorted(years_data.keys())
+        years = list(years_data)  # Already in ascending order
         print(f"Found data for years: {', '.join(map(str, years))}")
         
         # Create charts for each year
@@ -226,10 +174,12 @@ if __name__ == "__main__":
             year_data = years_data[year]
             
             # Only create charts if there's enough data (more than 30 days)
-            if len(year_data) >= 30:
-                plot_active_energy_chart(year_data, year, output_dir=OUTPUT_DIR)
+            if len(year_data['dates']) >= 30:
+                plot_active_energy_chart(year_data, year, output_dir=OUTPUT_DIR, fig=chart_figure)
             else:
-                print(f"Skipping year {year} - not enough data (only {len(year_data)} days)")
+                print(f"Skipping year {year} - not enough data (only {len(year_data['dates'])} days)")
+        
+        plt.close(chart_figure)
         
         print(f"\nAll charts saved to '{OUTPUT_DIR}/' directory")
         print("Charts generated successfully!")
@@ -4,131 +4,99 @@ Visualizes walking and running distance data from Apple Health.
 Creates charts showing trends over time and patterns in distance traveled.
 """
 
+import matplotlib
+# Render straight to PNG files without initialising a GUI backend
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import numpy as np
-from datetime import datetime
-import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
+import sys
 
-def ensure_dir(directory):
-    """Ensure a directory exists, creating it if necessary."""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Created directory: {directory}")
-    return directory
+from _viz_common import (DPI, PNG_OPTIONS, STATS_BBOX, ensure_dir, load_timeseries,
+                         calculate_moving_average, group_by_year, is_up_to_date)
+
+# Daily distance goals (km), as a column for comparing against every day at once
+GOALS_KM = np.array([[5], [10]])
 
 def load_distance_data(data_dir='data', filename='distance_data.json'):
     """Load distance data from JSON file in the specified directory."""
-    json_path = os.path.join(data_dir, filename)
-    
-    # Check if file exists
-    if not os.path.exists(json_path):
-        raise FileNotFoundError(f"Data file not found at '{json_path}'. Please run extract_distance.py first.")
-    
-    print(f"Loading data from {json_path}")
-    with open(json_path, 'r') as f:
-        data = json.load(f)
-    
-    # Convert date strings back to datetime.date objects
-    for entry in data:
-        entry['date'] = datetime.fromisoformat(entry['date']).date()
-    
-    return data
-
-def calculate_moving_average(data, window_size):
-    """Calculate moving average for a data series."""
-    moving_avg = []
-    
-    for i in range(len(data)):
-        if i < window_size - 1:
-            window = data[:i+1]
-        else:
-            window = data[i-window_size+1:i+1]
-        moving_avg.append(sum(window) / len(window))
-    
-    return moving_avg
-
-def group_by_year(data):
-    """Group data by year."""
-    years_data = {}
-    
-    for entry in data:
-        year = entry['date'].year
-        if year not in years_data:
-            years_data[year] = []
-        years_data[year].append(entry)
-    
-    return years_data
+    return load_timeseries(data_dir, filename, 'distance_km', 'extract_distance.py')
 
-def plot_distance_chart(data, year=None, output_dir='outputs'):
+def plot_distance_chart(data, year=None, output_dir='outputs', fig=None, source_mtime=None):
     """Create visualization for walking/running distance."""
-    # Extract dates and values
-    dates = [entry['date'] for entry in data]
-    distance_values = [entry['distance_km'] for entry in data]
-    
     # Set default output file based on year
     year_str = f"_{year}" if year else ""
     output_file = os.path.join(output_dir, f"distance_chart{year_str}.png")
     
+    # Keep the chart if it was saved after the data last changed
+    if is_up_to_date(output_file, source_mtime):
+        print(f"'{output_file}' is up to date, skipping")
+        return
+    
+    dates = data['dates']
+    distance_values = data['values']
+    
     # Ensure output directory exists
     ensure_dir(output_dir)
     
-    # Convert dates to matplotlib dates
-    dates_mdates = mdates.date2num(dates)
-    
     # Calculate moving average (7-day window)
     window_size = 7
     moving_avg = calculate_moving_average(distance_values, window_size)
     
-    # Create the plot
-    plt.figure(figsize=(15, 8))
+    # Draw on the shared figure when one is given, otherwise on a new one
+    owns_figure = fig is None
+    if owns_figure:
+        fig = plt.figure(figsize=(15, 8))
+    else:
+        fig.clf()
+    ax = fig.add_subplot()
     
     # Define colors
     bar_color = '#4CAF50'  # green
     line_color = '#3a7ebf'  # blue
     
     # Create bar chart
-    plt.bar(dates_mdates, distance_values, label='Daily Distance', color=bar_color, alpha=0.7)
+    ax.bar(dates, distance_values, label='Daily Distance', color=bar_color, alpha=0.7)
     
     # Plot 7-day moving average
-    plt.plot(dates_mdates, moving_avg, color=line_color, linewidth=2.5, 
-             label=f'{window_size}-Day Moving Average')
+    ax.plot(dates, moving_avg, color=line_color, linewidth=2.5, 
+            label=f'{window_size}-Day Moving Average')
     
     # Add reference lines for common distance goals
-    plt.axhline(y=5, color='#ffa726', linestyle='--', alpha=0.5, label='5 km Goal')
-    plt.axhline(y=10, color='#e55934', linestyle='--', alpha=0.5, label='10 km Goal')
+    ax.axhline(y=5, color='#ffa726', linestyle='--', alpha=0.5, label='5 km Goal')
+    ax.axhline(y=10, color='#e55934', linestyle='--', alpha=0.5, label='10 km Goal')
     
     # Configure x-axis
     if year:
         # For single year charts, show months
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%b'))
-        plt.gca().xaxis.set_major_locator(mdates.MonthLocator())
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%b'))
+        ax.xaxis.set_major_locator(mdates.MonthLocator())
     else:
         # For all data, show year-month
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
-        plt.gca().xaxis.set_major_locator(mdates.MonthLocator(interval=2))
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
+        ax.xaxis.set_major_locator(mdates.MonthLocator(interval=2))
     
-    plt.gcf().autofmt_xdate()
+    fig.autofmt_xdate()
     
     # Configure y-axis
-    plt.ylabel('Distance (km)')
+    ax.set_ylabel('Distance (km)')
     
     # Add grid, legend and title
-    plt.grid(True, alpha=0.3)
-    plt.legend(loc='upper left')
+    ax.grid(True, alpha=0.3)
+    ax.legend(loc='upper left')
     
     # Set title based on year
     title = f"Walking/Running Distance in {year}" if year else "Walking/Running Distance Over All Years"
-    plt.title(title)
+    ax.set_title(title)
     
-    # Calculate statistics
-    avg_distance = sum(distance_values) / len(distance_values)
-    min_distance = min(distance_values)
-    max_distance = max(distance_values)
-    total_distance = sum(distance_values)
-    days_over_5km = sum(1 for d in distance_values if d >= 5)
-    days_over_10km = sum(1 for d in distance_values if d >= 10)
+    # Calculate statistics: one sum gives the total and the average, and one
+    # broadcast comparison counts the days over both goals
+    total_distance = distance_values.sum()
+    avg_distance = total_distance / len(distance_values)
+    days_over_5km, days_over_10km = np.count_nonzero(distance_values >= GOALS_KM, axis=1)
     
     # Add text box with statistics
     stats_text = (
@@ -138,55 +106,60 @@ def plot_distance_chart(data, year=None, output_dir='outputs'):
         f"Days ≥ 5 km: {days_over_5km} ({days_over_5km/len(dates)*100:.1f}%)\n"
         f"Days ≥ 10 km: {days_over_10km} ({days_over_10km/len(dates)*100:.1f}%)"
     )
-    plt.figtext(0.15, 0.02, stats_text, fontsize=10, 
-                bbox={'facecolor': 'white', 'alpha': 0.8, 'pad': 5})
+    fig.text(0.15, 0.02, stats_text, fontsize=10, bbox=STATS_BBOX)
     
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=DPI, pil_kwargs=PNG_OPTIONS)
     print(f"Distance chart saved as '{output_file}'")
-    plt.close()
+    if owns_figure:
+        plt.close(fig)
 
-def plot_cumulative_distance(data, output_dir='outputs'):
+def plot_cumulative_distance(data, output_dir='outputs', fig=None, source_mtime=None):
     """Create a visualization of cumulative distance over time."""
-    # Extract dates and sort by date
-    sorted_data = sorted(data, key=lambda x: x['date'])
-    dates = [entry['date'] for entry in sorted_data]
-    distances = [entry['distance_km'] for entry in sorted_data]
-    
-    # Calculate cumulative distance
-    cumulative_distance = np.cumsum(distances)
-    
     # Set output file
     output_file = os.path.join(output_dir, "cumulative_distance_chart.png")
     
+    # Keep the chart if it was saved after the data last changed
+    if is_up_to_date(output_file, source_mtime):
+        print(f"'{output_file}' is up to date, skipping")
+        return
+    
+    # The dates are already sorted at load time
+    dates = data['dates']
+    
+    # Calculate cumulative distance
+    cumulative_distance = np.cumsum(data['values'])
+    
     # Ensure output directory exists
     ensure_dir(output_dir)
     
-    # Convert dates to matplotlib dates
-    dates_mdates = mdates.date2num(dates)
-    
-    # Create the plot
-    plt.figure(figsize=(15, 8))
+    # Draw on the shared figure when one is given, otherwise on a new one
+    owns_figure = fig is None
+    if owns_figure:
+        fig = plt.figure(figsize=(15, 8))
+    else:
+        fig.clf()
+    ax = fig.add_subplot()
     
     # Plot cumulative distance
-    plt.plot(dates_mdates, cumulative_distance, color='#3a7ebf', linewidth=2.5)
+    ax.plot(dates, cumulative_distance, color='#3a7ebf', linewidth=2.5)
     
     # Configure x-axis
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
-    plt.gca().xaxis.set_major_locator(mdates.MonthLocator(interval=3))
-    plt.gcf().autofmt_xdate()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
+    ax.xaxis.set_major_locator(mdates.MonthLocator(interval=3))
+    fig.autofmt_xdate()
     
     # Configure y-axis
-    plt.ylabel('Cumulative Distance (km)')
+    ax.set_ylabel('Cumulative Distance (km)')
     
     # Format y-axis labels with commas for thousands
-    plt.gca().get_yaxis().set_major_formatter(
+    ax.get_yaxis().set_major_formatter(
         plt.matplotlib.ticker.FuncFormatter(lambda x, p: format(int(x), ','))
     )
     
     # Add grid and title
-    plt.grid(True, alpha=0.3)
-    plt.title('Cumulative Walking/Running Distance Over Time')
+    ax.grid(True, alpha=0.3)
+    ax.set_title('Cumulative Walking/Running Distance Over Time')
     
     # Calculate statistics
     total_distance = cumulative_distance[-1]
@@ -207,140 +180,148 @@ def plot_cumulative_distance(data, output_dir='outputs'):
         f"Equivalent to: {marathons:.1f} marathons\n"
         f"Earth circumference: {earth_percent:.2f}%"
     )
-    plt.figtext(0.15, 0.02, stats_text, fontsize=10, 
-                bbox={'facecolor': 'white', 'alpha': 0.8, 'pad': 5})
+    fig.text(0.15, 0.02, stats_text, fontsize=10, bbox=STATS_BBOX)
     
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=DPI, pil_kwargs=PNG_OPTIONS)
     print(f"Cumulative distance chart saved as '{output_file}'")
-    plt.close()
+    if owns_figure:
+        plt.close(fig)
 
-def plot_monthly_averages(data, output_dir='outputs'):
+def plot_monthly_averages(data, output_dir='outputs', fig=None, source_mtime=None):
     """Create a chart showing average distance by month across all years."""
-    from collections import defaultdict
-    
-    # Group by year and month
-    monthly_data = defaultdict(list)
-    
-    for entry in data:
-        date = entry['date']
-        # Create a key in the format (year, month)
-        key = (date.year, date.month)
-        monthly_data[key].append(entry['distance_km'])
+    # Set output file
+    output_file = os.path.join(output_dir, "monthly_distance_averages.png")
     
-    # Calculate monthly averages
-    monthly_avgs = {}
-    for (year, month), values in monthly_data.items():
-        monthly_avgs[(year, month)] = sum(values) / len(values)
+    # Keep the chart if it was saved after the data last changed
+    if is_up_to_date(output_file, source_mtime):
+        print(f"'{output_file}' is up to date, skipping")
+        return
     
-    # Sort by date
-    sorted_months = sorted(monthly_avgs.keys())
+    # Number each month from the first one, then sum and count the values of
+    # every month with one bincount each instead of a dict of lists
+    months = data['dates'].astype('datetime64[M]')
+    first_month = months.min()
+    keys = (months - first_month).astype(np.int64)
+    sums = np.bincount(keys, weights=data['values'])
+    counts = np.bincount(keys)
     
-    # Create x-axis labels and y-axis values
-    month_labels = [f"{year}-{month:02d}" for year, month in sorted_months]
-    avg_values = [monthly_avgs[key] for key in sorted_months]
+    # Keep only the months that have data
+    has_data = np.flatnonzero(counts)
+    avg_values = sums[has_data] / counts[has_data]
     
-    # Set output file
-    output_file = os.path.join(output_dir, "monthly_distance_averages.png")
+    # Create x-axis labels ('YYYY-MM')
+    month_labels = (first_month + has_data).astype(str)
     
     # Ensure output directory exists
     ensure_dir(output_dir)
     
-    # Create the plot
-    plt.figure(figsize=(15, 8))
+    # Draw on the shared figure when one is given, otherwise on a new one
+    owns_figure = fig is None
+    if owns_figure:
+        fig = plt.figure(figsize=(15, 8))
+    else:
+        fig.clf()
+    ax = fig.add_subplot()
+    
+    # Color bars based on average distance, choosing every color in one call
+    # rather than bar by bar
+    colors = np.select([avg_values < 2, avg_values < 5],
+                       ['#e55934', '#ffa726'],  # red, orange
+                       '#4CAF50')  # green
     
     # Plot monthly averages with colorization
-    bars = plt.bar(range(len(avg_values)), avg_values)
-    
-    # Color bars based on average distance
-    for i, bar in enumerate(bars):
-        if avg_values[i] < 2:
-            bar.set_color('#e55934')  # red
-        elif avg_values[i] < 5:
-            bar.set_color('#ffa726')  # orange
-        else:
-            bar.set_color('#4CAF50')  # green
+    ax.bar(range(len(avg_values)), avg_values, color=colors, edgecolor=colors)
     
     # Add reference lines for common goals
-    plt.axhline(y=2, color='#e55934', linestyle='--', alpha=0.3, label='2 km')
-    plt.axhline(y=5, color='#ffa726', linestyle='--', alpha=0.3, label='5 km')
+    ax.axhline(y=2, color='#e55934', linestyle='--', alpha=0.3, label='2 km')
+    ax.axhline(y=5, color='#ffa726', linestyle='--', alpha=0.3, label='5 km')
     
     # Configure x-axis
-    plt.xticks(range(len(avg_values)), month_labels, rotation=90)
+    ax.set_xticks(range(len(avg_values)), month_labels, rotation=90)
     
     # Configure y-axis
-    plt.ylabel('Average Daily Distance (km)')
+    ax.set_ylabel('Average Daily Distance (km)')
     
     # Add grid, legend and title
-    plt.grid(True, alpha=0.3, axis='y')
-    plt.legend()
-    plt.title('Average Daily Walking/Running Distance by Month')
+    ax.grid(True, alpha=0.3, axis='y')
+    ax.legend()
+    ax.set_title('Average Daily Walking/Running Distance by Month')
     
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=DPI, pil_kwargs=PNG_OPTIONS)
     print(f"Monthly distance averages chart saved as '{output_file}'")
-    plt.close()
+    if owns_figure:
+        plt.close(fig)
 
-def plot_distance_histogram(data, output_dir='outputs'):
+def plot_distance_histogram(data, output_dir='outputs', fig=None, source_mtime=None):
     """Create a histogram showing the distribution of daily distance values."""
-    # Extract distance values
-    distance_values = [entry['distance_km'] for entry in data]
-    
     # Set output file
     output_file = os.path.join(output_dir, "distance_histogram.png")
     
+    # Keep the chart if it was saved after the data last changed
+    if is_up_to_date(output_file, source_mtime):
+        print(f"'{output_file}' is up to date, skipping")
+        return
+    
+    distance_values = data['values']
+    
     # Ensure output directory exists
     ensure_dir(output_dir)
     
-    # Create the plot
-    plt.figure(figsize=(15, 8))
+    # Draw on the shared figure when one is given, otherwise on a new one
+    owns_figure = fig is None
+    if owns_figure:
+        fig = plt.figure(figsize=(15, 8))
+    else:
+        fig.clf()
+    ax = fig.add_subplot()
     
     # Create histogram with a reasonable number of bins
-    max_dist = max(distance_values)
+    max_dist = distance_values.max()
     bin_width = 0.5  # 0.5 km per bin
     num_bins = int(max_dist / bin_width) + 1
     
-    n, bins, patches = plt.hist(distance_values, bins=num_bins, alpha=0.7, color='#3a7ebf')
-    
-    # Color the bins based on distance
-    for i, p in enumerate(patches):
-        if bins[i] < 2:
-            p.set_facecolor('#e55934')  # red
-        elif bins[i] < 5:
-            p.set_facecolor('#ffa726')  # orange
-        else:
-            p.set_facecolor('#4CAF50')  # green
+    # Bin the values with NumPy and draw the bins as bars, colouring them all
+    # in one call rather than patch by patch
+    counts, bins = np.histogram(distance_values, bins=num_bins)
+    colors = np.select([bins[:-1] < 2, bins[:-1] < 5],
+                       ['#e55934', '#ffa726'],  # red, orange
+                       '#4CAF50')  # green
+    ax.bar(bins[:-1], counts, width=np.diff(bins), align='edge', color=colors, alpha=0.7)
     
     # Add vertical lines for key distances
-    plt.axvline(x=2, color='#e55934', linestyle='--', alpha=0.5, label='2 km')
-    plt.axvline(x=5, color='#ffa726', linestyle='--', alpha=0.5, label='5 km')
-    plt.axvline(x=10, color='#4CAF50', linestyle='--', alpha=0.5, label='10 km')
+    ax.axvline(x=2, color='#e55934', linestyle='--', alpha=0.5, label='2 km')
+    ax.axvline(x=5, color='#ffa726', linestyle='--', alpha=0.5, label='5 km')
+    ax.axvline(x=10, color='#4CAF50', linestyle='--', alpha=0.5, label='10 km')
     
     # Configure axes
-    plt.xlabel('Daily Distance (km)')
-    plt.ylabel('Frequency (Days)')
-    plt.grid(True, alpha=0.3, axis='y')
-    plt.title('Distribution of Daily Walking/Running Distances')
-    plt.legend()
+    ax.set_xlabel('Daily Distance (km)')
+    ax.set_ylabel('Frequency (Days)')
+    ax.grid(True, alpha=0.3, axis='y')
+    ax.set_title('Distribution of Daily Walking/Running Distances')
+    ax.legend()
     
     # Calculate statistics
-    avg_distance = sum(distance_values) / len(distance_values)
-    median_distance = sorted(distance_values)[len(distance_values)//2]
+    avg_distance = distance_values.mean()
+    # Upper-middle value, selected in O(N) without sorting a copy
+    middle = len(distance_values) // 2
+    median_distance = np.partition(distance_values, middle)[middle]
     
     # Add statistics annotation
     stats_text = (
         f"Total days: {len(distance_values)}\n"
         f"Mean distance: {avg_distance:.2f} km\n"
         f"Median distance: {median_distance:.2f} km\n"
-        f"Range: {min(distance_values):.2f} - {max(distance_values):.2f} km"
+        f"Range: {distance_values.min():.2f} - {distance_values.max():.2f} km"
     )
-    plt.figtext(0.15, 0.02, stats_text, fontsize=10, 
-                bbox={'facecolor': 'white', 'alpha': 0.8, 'pad': 5})
+    fig.text(0.15, 0.02, stats_text, fontsize=10, bbox=STATS_BBOX)
     
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=DPI, pil_kwargs=PNG_OPTIONS)
     print(f"Distance histogram saved as '{output_file}'")
-    plt.close()
+    if owns_figure:
+        plt.close(fig)
 
 if __name__ == "__main__":
     # Set directories
@@ -356,21 +337,31 @@ if __name__ == "__main__":
         ensure_dir(OUTPUT_DIR)
         print(f"All charts will be saved to the '{OUTPUT_DIR}' directory")
         
+        # Charts saved after the data file last changed are kept, unless
+        # --force asks for every chart to be redrawn
+        if '--force' in sys.argv[1:]:
+            source_mtime = None
+        else:
+            source_mtime = os.path.getmtime(os.path.join(DATA_DIR, 'distance_data.json'))
+        
+        # One figure is cleared and redrawn for each all-years chart
+        chart_figure = plt.figure(figsize=(15, 8))
+        
         # Create chart for all data
         print("\nGenerating chart for all years combined...")
-        plot_distance_chart(distance_data, output_dir=OUTPUT_DIR)
+        plot_distance_chart(distance_data, output_dir=OUTPUT_DIR, fig=chart_figure, source_mtime=source_mtime)
         
         # Create cumulative distance chart
         print("\nGenerating cumulative distance chart...")
-        plot_cumulative_distance(distance_data, output_dir=OUTPUT_DIR)
+        plot_cumulative_distance(distance_data, output_dir=OUTPUT_DIR, fig=chart_figure, source_mtime=source_mtime)
         
         # Create monthly averages chart
         print("\nGenerating monthly averages chart...")
-        plot_monthly_averages(distance_data, output_dir=OUTPUT_DIR)
+        plot_monthly_averages(distance_data, output_dir=OUTPUT_DIR, fig=chart_figure, source_mtime=source_mtime)
         
         # Create histogram
         print("\nGenerating distance histogram...")
-        plot_distance_histogram(distance_data, output_dir=OUTPUT_DIR)
+        plot_distance_histogram(distance_data, output_dir=OUTPUT_DIR, fig=chart_figure, source_mtime=source_mtime)
         
         # Group data by year
         print("\nGrouping data by year...")
@@ -378,16 +369,31 @@ if __name__ == "__main__":
         years = sorted(years_data.keys())
         print(f"Found data for years: {', '.join(map(str, years))}")
         
-        # Create charts for each year
+        plt.close(chart_figure)
+        
+        # Choose the years to chart
+        chart_years = []
         for year in years:
-            print(f"\nGenerating chart for year {year}...")
             year_data = years_data[year]
             
             # Only create charts if there's enough data (more than 30 days)
-            if len(year_data) >= 30:
-                plot_distance_chart(year_data, year, output_dir=OUTPUT_DIR)
+            if len(year_data['dates']) >= 30:
+                chart_years.append(year)
             else:
-                print(f"Skipping year {year} - not enough data (only {len(year_data)} days)")
+                print(f"Skipping year {year} - not enough data (only {len(year_data['dates'])} days)")
+        
+        # The yearly charts are independent, so render them in parallel, one
+        # worker process per year up to one per CPU core. Each worker imports
+        # matplotlib again, so with a single worker the charts are drawn here
+        print(f"\nGenerating charts for years: {', '.join(map(str, chart_years))}...")
+        plot_year = partial(plot_distance_chart, output_dir=OUTPUT_DIR, source_mtime=source_mtime)
+        chart_data = [years_data[year] for year in chart_years]
+        max_workers = min(len(chart_years), os.cpu_count() or 1)
+        if max_workers < 2:
+            list(map(plot_year, chart_data, chart_years))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(plot_year, chart_data, chart_years))
         
         print(f"\nAll charts saved to '{OUTPUT_DIR}/' directory")
         print("Charts generated successfully!")
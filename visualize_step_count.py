@@ -4,68 +4,28 @@ Visualizes daily step count data from Apple Health.
 Creates charts showing daily steps and trends over time.
 """
 
+import matplotlib
+# Render straight to PNG files without initialising a GUI backend
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import numpy as np
-from datetime import datetime
-import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
 
-def ensure_dir(directory):
-    """Ensure a directory exists, creating it if necessary."""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Created directory: {directory}")
-    return directory
+from _viz_common import (DPI, PNG_OPTIONS, STATS_BBOX, ensure_dir, load_timeseries,
+                         calculate_moving_average, group_by_year)
 
 def load_step_count_data(data_dir='data', filename='step_count_data.json'):
     """Load step count data from JSON file in the specified directory."""
-    json_path = os.path.join(data_dir, filename)
-    
-    # Check if file exists
-    if not os.path.exists(json_path):
-        raise FileNotFoundError(f"Data file not found at '{json_path}'. Please run extract_step_count.py first.")
-    
-    print(f"Loading data from {json_path}")
-    with open(json_path, 'r') as f:
-        data = json.load(f)
-    
-    # Convert date strings back to datetime.date objects
-    for entry in data:
-        entry['date'] = datetime.fromisoformat(entry['date']).date()
-    
-    return data
-
-def calculate_moving_average(data, window_size):
-    """Calculate moving average for a data series."""
-    moving_avg = []
-    
-    for i in range(len(data)):
-        if i < window_size - 1:
-            window = data[:i+1]
-        else:
-            window = data[i-window_size+1:i+1]
-        moving_avg.append(sum(window) / len(window))
-    
-    return moving_avg
-
-def group_by_year(data):
-    """Group data by year."""
-    years_data = {}
-    
-    for entry in data:
-        year = entry['date'].year
-        if year not in years_data:
-            years_data[year] = []
-        years_data[year].append(entry)
-    
-    return years_data
+    # Step counts are whole numbers, so keep them as integers
+    return load_timeseries(data_dir, filename, 'steps', 'extract_step_count.py', dtype=np.int64)
 
-def plot_step_count_chart(data, year=None, output_dir='outputs'):
+def plot_step_count_chart(data, year=None, output_dir='outputs', fig=None):
     """Create visualization for daily step count."""
-    # Extract dates and values
-    dates = [entry['date'] for entry in data]
-    steps = [entry['steps'] for entry in data]
+    dates = data['dates']
+    steps = data['values']
     
     # Set default output file based on year
     year_str = f"_{year}" if year else ""
@@ -74,60 +34,63 @@ def plot_step_count_chart(data, year=None, output_dir='outputs'):
     # Ensure output directory exists
     ensure_dir(output_dir)
     
-    # Convert dates to matplotlib dates
-    dates_mdates = mdates.date2num(dates)
-    
     # Calculate moving average (7-day window)
     window_size = 7
     moving_avg = calculate_moving_average(steps, window_size)
     
-    # Create the plot
-    plt.figure(figsize=(15, 8))
+    # Draw on the shared figure when one is given, otherwise on a new one
+    owns_figure = fig is None
+    if owns_figure:
+        fig = plt.figure(figsize=(15, 8))
+    else:
+        fig.clf()
+    ax = fig.add_subplot()
     
     # Define colors
     bar_color = '#4CAF50'  # green
     line_color = '#3a7ebf'  # blue
     
     # Create bar chart
-    plt.bar(dates_mdates, steps, label='Steps', color=bar_color, alpha=0.7)
+    ax.bar(dates, steps, label='Steps', color=bar_color, alpha=0.7)
     
     # Plot 7-day moving average
-    plt.plot(dates_mdates, moving_avg, color=line_color, linewidth=2.5, 
-             label=f'{window_size}-Day Moving Average')
+    ax.plot(dates, moving_avg, color=line_color, linewidth=2.5, 
+            label=f'{window_size}-Day Moving Average')
     
     # Add reference lines for common step goals
-    plt.axhline(y=10000, color='#e55934', linestyle='--', alpha=0.5, label='10,000 Steps Goal')
+    ax.axhline(y=10000, color='#e55934', linestyle='--', alpha=0.5, label='10,000 Steps Goal')
     
     # Configure x-axis
     if year:
         # For single year charts, show months
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%b'))
-        plt.gca().xaxis.set_major_locator(mdates.MonthLocator())
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%b'))
+        ax.xaxis.set_major_locator(mdates.MonthLocator())
     else:
         # For all data, show year-month
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
-        plt.gca().xaxis.set_major_locator(mdates.MonthLocator(interval=2))
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
+        ax.xaxis.set_major_locator(mdates.MonthLocator(interval=2))
+    
+    fig.autofmt_xdate()
     
-    plt.gcf().autofmt_xdate()
+    # The range is needed for both the y-axis and the statistics
+    min_steps = steps.min()
+    max_steps = steps.max()
     
     # Configure y-axis
-    max_steps = max(steps) * 1.1  # Add 10% headroom
-    plt.ylim(0, max_steps)
-    plt.ylabel('Steps')
+    ax.set_ylim(0, max_steps * 1.1)  # Add 10% headroom
+    ax.set_ylabel('Steps')
     
     # Add grid, legend and title
-    plt.grid(True, alpha=0.3)
-    plt.legend(loc='upper left')
+    ax.grid(True, alpha=0.3)
+    ax.legend(loc='upper left')
     
     # Set title based on year
     title = f"Daily Step Count in {year}" if year else "Daily Step Count Over All Years"
-    plt.title(title)
+    ax.set_title(title)
     
-    # Calculate statistics
-    avg_steps = sum(steps) / len(steps)
-    min_steps = min(steps)
-    max_steps = max(steps)
-    days_over_10k = sum(1 for s in steps if s >= 10000)
+    # Calculate statistics, each as one NumPy reduction over the array
+    avg_steps = steps.mean()
+    days_over_10k = np.count_nonzero(steps >= 10000)
     percent_over_10k = (days_over_10k / len(steps)) * 100
     
     # Add text box with statistics
@@ -138,23 +101,21 @@ def plot_step_count_chart(data, year=None, output_dir='outputs'):
         f"Max steps: {max_steps:,}\n"
         f"Days e 10K steps: {days_over_10k} ({percent_over_10k:.1f}%)"
     )
-    plt.figtext(0.15, 0.02, stats_text, fontsize=10, 
-                bbox={'facecolor': 'white', 'alpha': 0.8, 'pad': 5})
+    fig.text(0.15, 0.02, stats_text, fontsize=10, bbox=STATS_BBOX)
     
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=DPI, pil_kwargs=PNG_OPTIONS)
     print(f"Step count chart saved as '{output_file}'")
-    plt.close()
+    if owns_figure:
+        plt.close(fig)
 
-def plot_cumulative_steps(data, output_dir='outputs'):
+def plot_cumulative_steps(data, output_dir='outputs', fig=None):
     """Create a visualization of cumulative step count over time."""
-    # Extract dates and sort by date
-    sorted_data = sorted(data, key=lambda x: x['date'])
-    dates = [entry['date'] for entry in sorted_data]
-    steps = [entry['steps'] for entry in sorted_data]
+    # The dates are already sorted at load time
+    dates = data['dates']
     
     # Calculate cumulative steps
-    cumulative_steps = np.cumsum(steps)
+    cumulative_steps = np.cumsum(data['values'])
     
     # Set output file
     output_file = os.path.join(output_dir, "cumulative_steps_chart.png")
@@ -162,31 +123,33 @@ def plot_cumulative_steps(data, output_dir='outputs'):
     # Ensure output directory exists
     ensure_dir(output_dir)
     
-    # Convert dates to matplotlib dates
-    dates_mdates = mdates.date2num(dates)
-    
-    # Create the plot
-    plt.figure(figsize=(15, 8))
+    # Draw on the shared figure when one is given, otherwise on a new one
+    owns_figure = fig is None
+    if owns_figure:
+        fig = plt.figure(figsize=(15, 8))
+    else:
+        fig.clf()
+    ax = fig.add_subplot()
     
     # Plot cumulative steps
-    plt.plot(dates_mdates, cumulative_steps, color='#3a7ebf', linewidth=2.5)
+    ax.plot(dates, cumulative_steps, color='#3a7ebf', linewidth=2.5)
     
     # Configure x-axis
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
-    plt.gca().xaxis.set_major_locator(mdates.MonthLocator(interval=3))
-    plt.gcf().autofmt_xdate()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
+    ax.xaxis.set_major_locator(mdates.MonthLocator(interval=3))
+    fig.autofmt_xdate()
     
     # Configure y-axis
-    plt.ylabel('Cumulative Steps')
+    ax.set_ylabel('Cumulative Steps')
     
     # Format y-axis labels with commas for thousands
-    plt.gca().get_yaxis().set_major_formatter(
+    ax.get_yaxis().set_major_formatter(
         plt.matplotlib.ticker.FuncFormatter(lambda x, p: format(int(x), ','))
     )
     
     # Add grid and title
-    plt.grid(True, alpha=0.3)
-    plt.title('Cumulative Step Count Over Time')
+    ax.grid(True, alpha=0.3)
+    ax.set_title('Cumulative Step Count Over Time')
     
     # Calculate statistics
     total_steps = cumulative_steps[-1]
@@ -199,38 +162,24 @@ def plot_cumulative_steps(data, output_dir='outputs'):
         f"Days recorded: {total_days}\n"
         f"Average steps per day: {avg_daily:.1f}"
     )
-    plt.figtext(0.15, 0.02, stats_text, fontsize=10, 
-                bbox={'facecolor': 'white', 'alpha': 0.8, 'pad': 5})
+    fig.text(0.15, 0.02, stats_text, fontsize=10, bbox=STATS_BBOX)
     
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=DPI, pil_kwargs=PNG_OPTIONS)
     print(f"Cumulative steps chart saved as '{output_file}'")
-    plt.close()
+    if owns_figure:
+        plt.close(fig)
 
-def plot_monthly_averages(data, output_dir='outputs'):
+def plot_monthly_averages(data, output_dir='outputs', fig=None):
     """Create a chart showing average steps by month across all years."""
-    from collections import defaultdict
-    
-    # Group by year and month
-    monthly_data = defaultdict(list)
-    
-    for entry in data:
-        date = entry['date']
-        # Create a key in the format (year, month)
-        key = (date.year, date.month)
-        monthly_data[key].append(entry['steps'])
-    
-    # Calculate monthly averages
-    monthly_avgs = {}
-    for (year, month), values in monthly_data.items():
-        monthly_avgs[(year, month)] = sum(values) / len(values)
-    
-    # Sort by date
-    sorted_months = sorted(monthly_avgs.keys())
+    # The dates are sorted, so each month is one run of the arrays starting
+    # at its first index; sum each run in one reduction
+    months, starts = np.unique(data['dates'].astype('datetime64[M]'), return_index=True)
+    counts = np.diff(np.append(starts, len(data['dates'])))
+    avg_values = np.add.reduceat(data['values'], starts) / counts
     
-    # Create x-axis labels and y-axis values
-    month_labels = [f"{year}-{month:02d}" for year, month in sorted_months]
-    avg_values = [monthly_avgs[key] for key in sorted_months]
+    # Create x-axis labels ('YYYY-MM')
+    month_labels = months.astype(str)
     
     # Set output file
     output_file = os.path.join(output_dir, "monthly_step_averages.png")
@@ -238,39 +187,42 @@ def plot_monthly_averages(data, output_dir='outputs'):
     # Ensure output directory exists
     ensure_dir(output_dir)
     
-    # Create the plot
-    plt.figure(figsize=(15, 8))
+    # Draw on the shared figure when one is given, otherwise on a new one
+    owns_figure = fig is None
+    if owns_figure:
+        fig = plt.figure(figsize=(15, 8))
+    else:
+        fig.clf()
+    ax = fig.add_subplot()
+    
+    # Color bars based on average (red if below 7500, yellow if below 10000,
+    # green if above), choosing every color in one call rather than bar by bar
+    colors = np.select([avg_values < 7500, avg_values < 10000],
+                       ['#e55934', '#ffa726'],  # red, orange
+                       '#4CAF50')  # green
     
     # Plot monthly averages with colorization
-    bars = plt.bar(range(len(avg_values)), avg_values)
-    
-    # Color bars based on average (red if below 7500, yellow if below 10000, green if above)
-    for i, bar in enumerate(bars):
-        if avg_values[i] < 7500:
-            bar.set_color('#e55934')  # red
-        elif avg_values[i] < 10000:
-            bar.set_color('#ffa726')  # orange
-        else:
-            bar.set_color('#4CAF50')  # green
+    ax.bar(range(len(avg_values)), avg_values, color=colors, edgecolor=colors)
     
     # Add reference line for 10k goal
-    plt.axhline(y=10000, color='#000000', linestyle='--', alpha=0.3, label='10,000 Steps Goal')
+    ax.axhline(y=10000, color='#000000', linestyle='--', alpha=0.3, label='10,000 Steps Goal')
     
     # Configure x-axis
-    plt.xticks(range(len(avg_values)), month_labels, rotation=90)
+    ax.set_xticks(range(len(avg_values)), month_labels, rotation=90)
     
     # Configure y-axis
-    plt.ylabel('Average Steps')
+    ax.set_ylabel('Average Steps')
     
     # Add grid, legend, and title
-    plt.grid(True, alpha=0.3, axis='y')
-    plt.legend()
-    plt.title('Average Daily Steps by Month')
+    ax.grid(True, alpha=0.3, axis='y')
+    ax.legend()
+    ax.set_title('Average Daily Steps by Month')
     
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=DPI, pil_kwargs=PNG_OPTIONS)
     print(f"Monthly averages chart saved as '{output_file}'")
-    plt.close()
+    if owns_figure:
+        plt.close(fig)
 
 if __name__ == "__main__":
     # Set directories
@@ -286,34 +238,52 @@ if __name__ == "__main__":
         ensure_dir(OUTPUT_DIR)
         print(f"All charts will be saved to the '{OUTPUT_DIR}' directory")
         
+        # One figure is cleared and redrawn for each all-years chart
+        chart_figure = plt.figure(figsize=(15, 8))
+        
         # Create chart for all data
         print("\nGenerating chart for all years combined...")
-        plot_step_count_chart(step_count_data, output_dir=OUTPUT_DIR)
+        plot_step_count_chart(step_count_data, output_dir=OUTPUT_DIR, fig=chart_figure)
         
         # Create cumulative steps chart
         print("\nGenerating cumulative steps chart...")
-        plot_cumulative_steps(step_count_data, output_dir=OUTPUT_DIR)
+        plot_cumulative_steps(step_count_data, output_dir=OUTPUT_DIR, fig=chart_figure)
         
         # Create monthly averages chart
         print("\nGenerating monthly averages chart...")
-        plot_monthly_averages(step_count_data, output_dir=OUTPUT_DIR)
+        plot_monthly_averages(step_count_data, output_dir=OUTPUT_DIR, fig=chart_figure)
         
         # Group data by year
         print("\nGrouping data by year...")
         years_data = group_by_year(step_count_data)
-        years = sorted(years_data.keys())
+        years = list(years_data)  # Already in ascending order
         print(f"Found data for years: {', '.join(map(str, years))}")
         
-        # Create charts for each year
+        plt.close(chart_figure)
+        
+        # Choose the years to chart
+        chart_years = []
         for year in years:
-            print(f"\nGenerating chart for year {year}...")
             year_data = years_data[year]
             
             # Only create charts if there's enough data (more than 30 days)
-            if len(year_data) >= 30:
-                plot_step_count_chart(year_data, year, output_dir=OUTPUT_DIR)
+            if len(year_data['dates']) >= 30:
+                chart_years.append(year)
             else:
-                print(f"Skipping year {year} - not enough data (only {len(year_data)} days)")
+                print(f"Skipping year {year} - not enough data (only {len(year_data['dates'])} days)")
+        
+        # The yearly charts are independent, so render them in parallel, one
+        # worker process per year up to one per CPU core. Each worker imports
+        # matplotlib again, so with a single worker the charts are drawn here
+        print(f"\nGenerating charts for years: {', '.join(map(str, chart_years))}...")
+        plot_year = partial(plot_step_count_chart, output_dir=OUTPUT_DIR)
+        chart_data = [years_data[year] for year in chart_years]
+        max_workers = min(len(chart_years), os.cpu_count() or 1)
+        if max_workers < 2:
+            list(map(plot_year, chart_data, chart_years))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(plot_year, chart_data, chart_years))
         
         print(f"\nAll charts saved to '{OUTPUT_DIR}/' directory")
         print("Charts generated successfully!")